@@ -1,9 +1,13 @@
+import json
+import queue
 import pyaudio
 import time
 import socket
 import threading
+from collections import deque
 from loguru import logger
 from network import connect_to_server
+from protocol import MessageReader, MSG_AUDIO, MSG_CONTROL, MSG_PLAY, MSG_OFFER, MSG_CLIP
 
 CHUNK_SIZE = 1024
 FORMAT = pyaudio.paInt16
@@ -15,6 +19,78 @@ shutdown_event = threading.Event()
 
 p = pyaudio.PyAudio()
 
+# Seconds to wait for a fetched clip before skipping it in the playlist
+FETCH_TIMEOUT = 15
+
+
+class CachedPlayback:
+    """Plays framed server messages, taking announced clips from the local clip cache.
+
+    Audio is written by a separate thread so that playing a whole clip never stops the socket being read.
+    """
+
+    def __init__(self, client, stream):
+        self.client = client
+        self.cache = client.clip_cache
+        self.playlist = deque()
+        self.requested = {}  # digest -> time the fetch was sent
+        self.playback_queue = queue.Queue()
+        self.player_thread = threading.Thread(target=self.play_queued, args=(stream,), daemon=True)
+        self.player_thread.start()
+
+    def play_queued(self, stream):
+        while not self.client.shutdown_event.is_set():
+            try:
+                pcm = self.playback_queue.get(timeout=0.5)
+            except queue.Empty:
+                continue
+            stream.write(pcm)
+
+    def handle(self, client_socket, kind, payload):
+        if kind == MSG_AUDIO:
+            if not self.client.is_muted:
+                self.playback_queue.put(payload)
+        elif kind == MSG_CONTROL:
+            logger.debug(f"Control message from server: {payload.decode()}")
+        elif kind == MSG_PLAY:
+            digests = json.loads(payload)
+            if not self.client.is_muted:
+                self.playlist.extend(digests)
+            self.fetch_missing(client_socket, digests)
+        elif kind == MSG_OFFER:
+            self.fetch_missing(client_socket, json.loads(payload))
+        elif kind == MSG_CLIP:
+            digest = payload[:64].decode()
+            self.requested.pop(digest, None)
+            try:
+                self.cache.store(digest, payload[64:])
+            except ValueError as e:
+                logger.error(f"Discarding clip from server: {e}")
+        self.play_ready()
+
+    def fetch_missing(self, client_socket, digests):
+        for digest in digests:
+            if digest not in self.requested and not self.cache.has(digest):
+                self.requested[digest] = time.monotonic()
+                client_socket.sendall(f"\nFETCH:{digest}\n".encode())
+
+    def play_ready(self):
+        """Queue clips from the head of the playlist, in order, for as long as they are cached."""
+        while self.playlist:
+            digest = self.playlist[0]
+            if self.cache.has(digest):
+                self.playback_queue.put(self.cache.load(self.playlist.popleft()))
+            elif time.monotonic() - self.requested.get(digest, time.monotonic()) > FETCH_TIMEOUT:
+                logger.warning(f"Clip {digest} was not received in time. Skipping it.")
+                self.requested.pop(digest, None)
+                self.playlist.popleft()
+            else:
+                break
+
+    def forget_requests(self):
+        # Fetches sent on a dropped connection will never be answered
+        self.requested.clear()
+
 
 def stream_audio(client, connection_status, broadcast_status, reconnect_delay, is_muted, client_socket):
     client.check_and_reconnect()  # Ensure fresh connection
@@ -25,12 +101,21 @@ def stream_audio(client, connection_status, broadcast_status, reconnect_delay, i
                     output=True,
                     frames_per_buffer=CHUNK_SIZE)
 
+    # With a clip cache the server sends framed messages; otherwise the stream is raw audio
+    playback = CachedPlayback(client, stream) if client.clip_cache else None
+    reader = None
+    admitted = False  # Whether the server has sent anything on the current connection
+
     while not shutdown_event.is_set():
         if not client_socket or client_socket.fileno() == -1:  # Check if socket is invalid or closed
             logger.debug("No active socket, attempting to reconnect.")
-            client_socket = connect_to_server(client.host, client.port, client.reconnect_delay, client.shutdown_event,
+            client_socket = connect_to_server(client.host, client.port, client.backoff, client.shutdown_event,
                                               client.socket_lock)
             if client_socket:
+                admitted = False
+                # Share the new connection so mute and pause changes reach the server on it
+                client.client_socket = client_socket
+                client.register_with_server()
                 connection_status.set("Connected")
                 broadcast_status.set("Broadcast Active")
             else:
@@ -49,22 +134,29 @@ def stream_audio(client, connection_status, broadcast_status, reconnect_delay, i
             if client_socket and client_socket.fileno() != -1:
                 data = client_socket.recv(CHUNK_SIZE)
                 if not data:
+                    # Falls through to the reconnect delay below instead of reconnecting at once
                     logger.warning("Server disconnected.")
-                    connection_status.set("Disconnected")
-                    broadcast_status.set("Not connected")
                     client_socket.close()
                     client_socket = None
-                    continue
-
-                if is_muted:
-                    continue
                 else:
-                    stream.write(data)
+                    if not admitted:
+                        # The server only writes once it has admitted the connection
+                        admitted = True
+                        client.backoff.reset()
+
+                    if playback:
+                        if not reader or reader.client_socket is not client_socket:
+                            reader = MessageReader(client_socket)
+                            playback.forget_requests()
+                        for kind, payload in reader.feed(data):
+                            playback.handle(client_socket, kind, payload)
+                    elif not client.is_muted:
+                        stream.write(data)
             else:
                 logger.warning("Invalid socket. Reconnecting...")
                 connection_status.set("Disconnected")
                 broadcast_status.set("Not connected")
-                time.sleep(reconnect_delay)
+                shutdown_event.wait(client.backoff.first_delay())
         except socket.timeout:
             pass
         except socket.error as e:
@@ -85,8 +177,11 @@ def stream_audio(client, connection_status, broadcast_status, reconnect_delay, i
         if client_socket is None:
             connection_status.set("Disconnected")
             broadcast_status.set("Not connected")
-            logger.debug("Attempting to reconnect...")
-            time.sleep(reconnect_delay)
+            # A dropped session waits a fully jittered delay so the fleet spreads out; a connection closed
+            # before the server sent anything was turned away, so keep backing off from the last attempt
+            delay = client.backoff.first_delay() if admitted else client.backoff.next_delay()
+            logger.debug(f"Attempting to reconnect in {delay:.1f} s...")
+            shutdown_event.wait(delay)
 
     stream.stop_stream()
     stream.close()
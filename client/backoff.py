@@ -0,0 +1,25 @@
+import random
+
+
+class Backoff:
+    """Decorrelated exponential backoff with jitter.
+
+    Each retry waits a random time between base and three times the previous wait, capped at cap, so
+    stations that lost the server at the same moment drift apart instead of retrying in lockstep.
+    """
+
+    def __init__(self, base, cap=60.0):
+        self.base = base
+        self.cap = cap
+        self.delay = base
+
+    def reset(self):
+        self.delay = self.base
+
+    def next_delay(self):
+        self.delay = min(self.cap, random.uniform(self.base, self.delay * 3))
+        return self.delay
+
+    def first_delay(self):
+        # Full jitter before the first attempt after a disconnect, which the whole fleet sees at once
+        return random.uniform(0, self.base)
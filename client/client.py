@@ -1,4 +1,5 @@
 import os
+import json
 import signal
 import socket
 import threading
@@ -6,6 +7,9 @@ import argparse
 from loguru import logger
 from config import load_config
 from network import connect_to_server
+from backoff import Backoff
+from protocol import CLIP_CACHE_CAPABILITY
+from clip_cache import ClipCache
 from audio import stream_audio, cleanup_audio
 from gui import create_gui, create_tray_icon
 
@@ -42,9 +46,23 @@ class RFAStreamClient:
         else:
             logger.info("Client is not muted by default")
 
+        # Reconnect attempts back off from reconnect_delay up to max_reconnect_delay, with jitter
+        self.backoff = Backoff(retry_delay, config.get('max_reconnect_delay', 60))
+
+        # Alerts outside these filters are not sent to this station at all. Empty lists mean "everything".
+        self.priorities = config.get('priorities', [])
+        self.incident_types = config.get('incident_types', [])
+        self.groups = config.get('groups', [])
+
+        # Clips are kept on disk so the server can announce alerts by clip ID instead of streaming them
+        self.clip_cache = None
+        if config.get('clip_cache', True):
+            self.clip_cache = ClipCache(os.path.join(os.getenv('APPDATA'), 'RFAStream', 'clip-cache'))
+
     def connect(self):
-        self.client_socket = connect_to_server(self.host, self.port, self.reconnect_delay, self.shutdown_event, self.socket_lock)
+        self.client_socket = connect_to_server(self.host, self.port, self.backoff, self.shutdown_event, self.socket_lock)
         if self.client_socket:
+            self.register_with_server()
             self.connection_status.set("Connected")
             self.broadcast_status.set("Broadcast Active")
         else:
@@ -70,7 +88,9 @@ class RFAStreamClient:
                 self.client_socket = None
 
             # Attempt to reconnect to the server
-            self.client_socket = connect_to_server(self.host, self.port, self.reconnect_delay, self.shutdown_event, self.socket_lock)
+            self.client_socket = connect_to_server(self.host, self.port, self.backoff, self.shutdown_event, self.socket_lock)
+            if self.client_socket:
+                self.register_with_server()
             return self.client_socket
         except Exception as e:
             logger.error(f"Reconnection failed: {e}")
@@ -89,6 +109,29 @@ class RFAStreamClient:
         except Exception as e:
             logger.error(f"Error requesting pause state: {e}")
 
+    def register_with_server(self):
+        """Send everything the server needs to know about this station on a new connection."""
+        if self.clip_cache:
+            try:
+                self.client_socket.sendall(f"\nCAPABILITIES:{CLIP_CACHE_CAPABILITY}\n".encode())
+            except Exception as e:
+                logger.error(f"Error sending capabilities: {e}")
+        self.send_subscription()
+
+    def send_subscription(self):
+        """Tell the server which alerts to send this station. Takes effect immediately, without reconnecting."""
+        subscription = {
+            'muted': self.is_muted,
+            'priorities': self.priorities,
+            'incident_types': self.incident_types,
+            'groups': self.groups
+        }
+        try:
+            # Leading newline separates it from a preceding bare command such as PING
+            self.client_socket.sendall(f"\nSUBSCRIBE:{json.dumps(subscription)}\n".encode())
+        except Exception as e:
+            logger.error(f"Error sending subscription: {e}")
+
     def toggle_client_mute(self):
         self.is_muted = not self.is_muted
         if self.is_muted:
@@ -97,6 +140,8 @@ class RFAStreamClient:
         else:
             logger.info("Client unmuted.")
             self.mute_button.config(text="Mute Client")
+        # The server stops (or resumes) sending audio to muted stations
+        self.send_subscription()
 
     def toggle_broadcast_pause(self):
         self.check_and_reconnect()
@@ -0,0 +1,41 @@
+import os
+import re
+import hashlib
+from loguru import logger
+
+DIGEST_PATTERN = re.compile(r"[0-9a-f]{64}")
+
+
+class ClipCache:
+    """Clips stored on disk under the SHA-256 of their content, so the server sends each one only once."""
+
+    def __init__(self, folder):
+        self.folder = folder
+        os.makedirs(folder, exist_ok=True)
+
+    def path(self, digest):
+        # Digests come from the network; never let one name a path outside the cache folder
+        if not DIGEST_PATTERN.fullmatch(digest):
+            raise ValueError(f"Invalid clip digest: {digest!r}")
+        return os.path.join(self.folder, f"{digest}.pcm")
+
+    def has(self, digest):
+        try:
+            return os.path.exists(self.path(digest))
+        except ValueError:
+            return False
+
+    def load(self, digest):
+        with open(self.path(digest), 'rb') as clip_file:
+            return clip_file.read()
+
+    def store(self, digest, data):
+        if hashlib.sha256(data).hexdigest() != digest:
+            raise ValueError(f"Clip content does not match digest {digest}")
+
+        path = self.path(digest)
+        temp_path = f"{path}.tmp"
+        with open(temp_path, 'wb') as clip_file:
+            clip_file.write(data)
+        os.replace(temp_path, path)
+        logger.info(f"Cached clip {digest} ({len(data)} bytes)")
@@ -14,8 +14,13 @@ def load_config(config_file_name='client-config.json'):
         'host': '127.0.0.1',
         'port': 12345,
         'reconnect_delay': 5,
+        'max_reconnect_delay': 60,
         'heartbeat_enabled': True,
-        'start_muted': False
+        'start_muted': False,
+        'priorities': [],
+        'incident_types': [],
+        'groups': [],
+        'clip_cache': True
     }
 
     # Check if the config file exists
@@ -1,10 +1,9 @@
 import socket
-import time
 from loguru import logger
 from gui import create_gui
 
 
-def connect_to_server(host, port, reconnect_delay, shutdown_event, socket_lock):
+def connect_to_server(host, port, backoff, shutdown_event, socket_lock):
     client_socket = None
 
     while not shutdown_event.is_set():
@@ -17,6 +16,8 @@ def connect_to_server(host, port, reconnect_delay, shutdown_event, socket_lock):
                     logger.info(f"Connecting to {host}:{port}...")
                     client_socket.connect((host, port))
 
+                    # The backoff is reset once the server sends its first byte, not here: a server at
+                    # capacity accepts and then closes, and resetting on connect would retry it in a tight loop
                     logger.info(f"Connected to {host}:{port}")
                     return client_socket
 
@@ -25,7 +26,8 @@ def connect_to_server(host, port, reconnect_delay, shutdown_event, socket_lock):
 
         except (socket.error, OSError) as e:
 
-            logger.error(f"Error in connect_to_server: {e}")
-            time.sleep(reconnect_delay)
+            delay = backoff.next_delay()
+            logger.error(f"Error in connect_to_server: {e}. Retrying in {delay:.1f} s")
+            shutdown_event.wait(delay)
 
     return None
@@ -0,0 +1,55 @@
+import struct
+
+# Must match server/protocol.py
+MESSAGE_HEADER = struct.Struct("<BI")  # message type, payload length
+
+MSG_AUDIO = 1  # PCM to play immediately
+MSG_CONTROL = 2  # Control text: PAUSED, RESUMED, HEARTBEAT
+MSG_PLAY = 3  # JSON list of clip digests to play in order
+MSG_OFFER = 4  # JSON list of clip digests to fetch if they are not cached
+MSG_CLIP = 5  # 64-character hex digest followed by the clip's PCM
+
+CLIP_CACHE_CAPABILITY = "clip-cache"
+
+# Written by the server on the raw stream to mark where framed messages start
+FRAMED_MARKER = b"CONTROL:FRAMED\n"
+
+
+class MessageReader:
+    """Splits the server's byte stream into messages.
+
+    Until the server sends FRAMED_MARKER the stream is raw audio, which is passed through as MSG_AUDIO.
+    Servers without clip cache support never send the marker, so the stream stays raw.
+    """
+
+    def __init__(self, client_socket):
+        self.client_socket = client_socket
+        self.framed = False
+        self.buffer = bytearray()
+
+    def feed(self, data):
+        self.buffer += data
+        messages = []
+
+        if not self.framed:
+            index = self.buffer.find(FRAMED_MARKER)
+            if index == -1:
+                # Hold back just enough bytes to recognise a marker split across reads
+                raw_length = max(len(self.buffer) - len(FRAMED_MARKER) + 1, 0)
+                raw = bytes(self.buffer[:raw_length])
+                del self.buffer[:raw_length]
+                return [(MSG_AUDIO, raw)] if raw else []
+
+            if index:
+                messages.append((MSG_AUDIO, bytes(self.buffer[:index])))
+            del self.buffer[:index + len(FRAMED_MARKER)]
+            self.framed = True
+
+        while len(self.buffer) >= MESSAGE_HEADER.size:
+            kind, length = MESSAGE_HEADER.unpack_from(self.buffer)
+            end = MESSAGE_HEADER.size + length
+            if len(self.buffer) < end:
+                break
+            messages.append((kind, bytes(self.buffer[MESSAGE_HEADER.size:end])))
+            del self.buffer[:end]
+        return messages
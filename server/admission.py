@@ -0,0 +1,158 @@
+import os
+import json
+import time
+import threading
+from collections import deque
+from pathlib import Path
+from loguru import logger
+
+try:
+    import resource
+except ImportError:  # Windows has no file descriptor limit to fit into
+    resource = None
+
+# Connection admission settings; overridden by the "admission" section of the server config
+DEFAULT_ADMISSION = {
+    'backlog': 1024,  # listen() backlog; the kernel caps it at net.core.somaxconn
+    'accept_batch': 64,  # Most connections taken off the backlog per wakeup of the accept loop
+    'handshake_rate': 50.0,  # Connections admitted per second, per worker
+    'handshake_burst': 100,  # Connections admitted back to back before the rate applies
+    'max_pending': 2048,  # Accepted connections waiting for admission; beyond this new ones are closed
+    'max_clients': 1000,  # Connected clients per worker
+    'known_stations_file': 'known-stations.json'  # Addresses admitted before, so they go first after a restart
+}
+
+SAVE_INTERVAL = 10.0
+
+# Descriptors kept free for the listener, clip files, logs and the journal
+RESERVED_FDS = 64
+
+# Pause after the accept loop fails (e.g. EMFILE) so it does not spin while descriptors are exhausted
+ACCEPT_ERROR_DELAY = 0.1
+
+
+def fit_to_fd_limit(settings):
+    """Return settings with max_pending + max_clients clamped to the process's open file limit.
+
+    Every pending and connected client holds a socket; past RLIMIT_NOFILE accept() fails with EMFILE and
+    so does opening a clip or the journal. The soft limit is raised as far as the hard limit allows first.
+    """
+    if resource is None:
+        return settings
+
+    clients = settings['max_pending'] + settings['max_clients']
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft != resource.RLIM_INFINITY and soft < clients + RESERVED_FDS:
+        target = clients + RESERVED_FDS if hard == resource.RLIM_INFINITY else min(hard, clients + RESERVED_FDS)
+        try:
+            resource.setrlimit(resource.RLIMIT_NOFILE, (target, hard))
+            soft = target
+        except (ValueError, OSError) as e:
+            logger.warning(f"Could not raise the open file limit from {soft}: {e}")
+    if soft == resource.RLIM_INFINITY or soft >= clients + RESERVED_FDS:
+        return settings
+
+    scale = max(soft - RESERVED_FDS, 2) / clients
+    fitted = {**settings,
+              'max_pending': max(1, int(settings['max_pending'] * scale)),
+              'max_clients': max(1, int(settings['max_clients'] * scale))}
+    logger.warning(f"Open file limit is {soft}: lowering max_pending to {fitted['max_pending']} and "
+                   f"max_clients to {fitted['max_clients']}")
+    return fitted
+
+
+class AdmissionControl:
+    """Admits new connections at a bounded rate, stations seen before first.
+
+    After a server restart the whole fleet reconnects at once. The accept loop takes connections off the
+    backlog as fast as they arrive so it never overflows, and queues them here; a token bucket then paces
+    their handshakes. Stations whose address has been admitted before jump the queue. When the queue is
+    full, further connections are closed and the client's backoff spreads its retry out.
+    """
+
+    def __init__(self, admit, shutdown_event, handshake_rate=50.0, handshake_burst=100, max_pending=2048,
+                 known_stations_file=None, **_):
+        self.admit = admit
+        self.shutdown_event = shutdown_event
+        self.handshake_rate = handshake_rate
+        self.handshake_burst = handshake_burst
+        self.max_pending = max_pending
+        self.known_stations_file = Path(known_stations_file) if known_stations_file else None
+        self.known = self.load_known_stations()
+        self.unsaved = False
+        self.pending_known = deque()
+        self.pending_new = deque()
+        self.condition = threading.Condition()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def offer(self, client_socket, client_address):
+        with self.condition:
+            accepted = len(self.pending_known) + len(self.pending_new) < self.max_pending
+            if accepted:
+                queue = self.pending_known if client_address[0] in self.known else self.pending_new
+                queue.append((client_socket, client_address))
+                self.condition.notify()
+
+        if not accepted:
+            logger.warning(f"Admission queue full, turning away {client_address}")
+            client_socket.close()
+
+    def run(self):
+        tokens, refilled = float(self.handshake_burst), time.monotonic()
+        saved = refilled
+        while not self.shutdown_event.is_set():
+            now = time.monotonic()
+            tokens = min(self.handshake_burst, tokens + (now - refilled) * self.handshake_rate)
+            refilled = now
+            if self.unsaved and now - saved > SAVE_INTERVAL:
+                self.save_known_stations()
+                saved = now
+            if tokens < 1:
+                time.sleep((1 - tokens) / self.handshake_rate)
+                continue
+
+            with self.condition:
+                if not self.pending_known and not self.pending_new:
+                    self.condition.wait(1.0)
+                    continue
+                client_socket, client_address = (self.pending_known or self.pending_new).popleft()
+
+            tokens -= 1
+            if client_address[0] not in self.known:
+                self.known.add(client_address[0])
+                self.unsaved = True
+            self.admit(client_socket, client_address)
+
+    def close(self):
+        """Close connections still waiting for admission and record the stations seen."""
+        with self.condition:
+            waiting = list(self.pending_known) + list(self.pending_new)
+            self.pending_known.clear()
+            self.pending_new.clear()
+        for client_socket, _ in waiting:
+            client_socket.close()
+        if self.unsaved:
+            self.save_known_stations()
+
+    def load_known_stations(self):
+        if not self.known_stations_file or not self.known_stations_file.exists():
+            return set()
+        try:
+            return set(json.loads(self.known_stations_file.read_text()))
+        except (OSError, ValueError) as e:
+            logger.error(f"Could not read known stations from {self.known_stations_file}: {e}")
+            return set()
+
+    def save_known_stations(self):
+        if not self.known_stations_file:
+            return
+        # Merge with the file so fan-out workers sharing it do not drop each other's stations
+        self.known |= self.load_known_stations()
+        self.unsaved = False
+        temp_path = self.known_stations_file.with_suffix(f".{os.getpid()}.tmp")
+        try:
+            temp_path.write_text(json.dumps(sorted(self.known)))
+            os.replace(temp_path, self.known_stations_file)
+        except OSError as e:
+            logger.error(f"Could not save known stations to {self.known_stations_file}: {e}")
@@ -1,78 +1,241 @@
+import os
+import json
 import time
 import socket
 import threading
+from functools import partial
 from pathlib import Path
 from loguru import logger
 from watchdog.observers import Observer
 from concurrent.futures import ThreadPoolExecutor
-from watchdog_monitor import FileHandler
+from watchdog_monitor import FileHandler, ClipSyncHandler
+from routing import RoutingIndex, Subscription
+from clips import ClipStore
+from clip_prep import ClipPreparer
+from mixer import AlertMixer
+from admission import AdmissionControl, DEFAULT_ADMISSION, ACCEPT_ERROR_DELAY, fit_to_fd_limit
+from journal import Journal, AlertRecord, RESULT_STREAMED, RESULT_ANNOUNCED, RESULT_FAILED, MAX_RECORD_AGE_NS
+from writer import ClientWriter, FileRegion, DEFAULT_STREAMING, configure_client_socket
+from protocol import (MESSAGE_HEADER, MSG_AUDIO, MSG_CONTROL, MSG_PLAY, MSG_OFFER, MSG_CLIP, CLIP_CACHE_CAPABILITY,
+                      FRAMED_MARKER, LINE_COMMANDS)
 
 shutdown_event = threading.Event()
 
 
 class AudioServer:
-    def __init__(self, host, port, watchdog_folder, audio_files_folder, max_workers=10):
+    def __init__(self, host, port, watchdog_folder, audio_files_folder, reuse_port=False, monitor_folder=True,
+                 alert_groups=None, clip_preparation=None, mixing=None, streaming=None, admission=None, journal=None):
         self.host = host
         self.port = port
         self.watchdog_folder = Path(watchdog_folder)
         self.audio_files_folder = Path(audio_files_folder)
         self.server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        if os.name == "nt":
+            # On Windows SO_REUSEADDR would let a second server bind the same port and split the fleet.
+            # Listeners there have no TIME_WAIT problem, so claim the port exclusively instead.
+            self.server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_EXCLUSIVEADDRUSE, 1)
+        else:
+            # A restarted server must be able to bind while the old connections are still in TIME_WAIT
+            self.server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if reuse_port:
+            # Let several worker processes accept on the same port; the kernel balances new connections
+            self.server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
         self.server_socket.bind((host, port))
-        self.server_socket.listen(5)
+        self.admission_settings = fit_to_fd_limit({**DEFAULT_ADMISSION, **(admission or {})})
+        self.server_socket.listen(self.admission_settings['backlog'])
         self.clients = []
+        self.routes = RoutingIndex()
+        self.writers = {}  # Each client's send queue; the only path data takes to a client
+        self.retired_send_calls = 0
+        self.retired_bytes_sent = 0
         self.client_status = {}
         self.broadcast_paused = False
         self.heartbeat_interval = 5
+        self.streaming = {**DEFAULT_STREAMING, **(streaming or {})}
+        # sendfile lets the kernel copy clip pages straight to each socket; elsewhere send memoryview slices
+        self.use_sendfile = hasattr(os, "sendfile")
 
-        # Initialize folder monitoring (watchdog)
-        self.observer = Observer()
-        self.event_handler = FileHandler(self, self.audio_files_folder)
-        self.observer.schedule(self.event_handler, self.watchdog_folder, recursive=False)
+        # Clips by source path and by digest, for streaming and for serving client cache fetches
+        self.clips = ClipStore(ClipPreparer(**clip_preparation) if clip_preparation else None)
 
-        # Initialize thread pool
-        self.executor = ThreadPoolExecutor(max_workers=max_workers)
+        # Initialize folder monitoring (watchdog). Fan-out workers leave this to the dispatcher.
+        self.observer = None
+        if monitor_folder:
+            self.observer = Observer()
+            self.event_handler = FileHandler(self, self.audio_files_folder, alert_groups, self.clips, mixing is not None,
+                                             self.streaming['chunk_size'])
+            self.observer.schedule(self.event_handler, self.watchdog_folder, recursive=False)
+            self.observer.schedule(ClipSyncHandler(self), self.audio_files_folder, recursive=False)
+
+        # What was broadcast, when and to whom, written off the streaming thread
+        self.journal = Journal(journal['folder']) if journal else None
+        self.alert_records = {}  # Incident ID -> AlertRecord while the alert is in flight
+        self.records_lock = threading.Lock()
+
+        # Optional concurrent alert mixing; without it alerts are streamed one after another
+        self.mixer = AlertMixer(self, shutdown_event, **mixing) if mixing is not None else None
+
+        # Initialize thread pool; each connected client holds one thread
+        self.max_clients = self.admission_settings['max_clients']
+        self.executor = ThreadPoolExecutor(max_workers=self.max_clients)
+
+        # New connections wait here until their handshake is admitted
+        self.admission = AdmissionControl(self.admit_client, shutdown_event, **self.admission_settings)
 
         # Heartbeat thread
         self.heartbeat_thread = threading.Thread(target=self.start_heartbeat, daemon=True)
         self.heartbeat_thread.start()
 
+    def admit_client(self, client_socket, client_address):
+        if len(self.clients) >= self.max_clients:
+            logger.warning(f"Client limit of {self.max_clients} reached, turning away {client_address}")
+            client_socket.close()
+            return
+        self.executor.submit(self.handle_client, client_socket, client_address)
+
     def handle_client(self, client_socket, client_address):
         logger.info(f"New client connected: {client_address}")
+        try:
+            configure_client_socket(client_socket, **self.streaming)
+        except OSError as e:
+            logger.warning(f"Could not apply socket options for client {client_address}: {e}")
+        self.writers[client_socket] = ClientWriter(client_socket, client_address, self.remove_client,
+                                                   self.use_sendfile, **self.streaming)
         self.clients.append(client_socket)
+        # Until the client sends a subscription it receives every alert
+        self.routes.add(client_socket)
 
         # Send the current broadcast state to the client
         status_message = "PAUSED" if self.broadcast_paused else "RESUMED"
-        try:
-            client_socket.sendall(f"CONTROL:{status_message}".encode())
-        except Exception as e:
-            logger.error(f"Error sending status to client {client_address}: {e}")
+        self.send_message(client_socket, MSG_CONTROL, status_message.encode())
 
         # Handle incoming client commands
+        buffer = ""
         try:
             while True:
-                data = client_socket.recv(1024).decode().strip()
+                data = client_socket.recv(1024).decode()
                 if not data:
                     logger.warning(f"Client {client_address} disconnected.")
                     break
 
-                if data == "PAUSE":
-                    self.broadcast_paused = True
-                    self.broadcast_control_message("PAUSED")
-                    logger.info("Broadcast paused by client.")
-                elif data == "RESUME":
-                    self.broadcast_paused = False
-                    self.broadcast_control_message("RESUMED")
-                    logger.info("Broadcast resumed by client.")
-                elif data == "PING":
-                    logger.debug(f"Received successful PING from client {client_address}")
-                else:
-                    logger.warning(f"Unknown command from client {client_address}: {data}")
+                # Line commands may span reads, and a read can even end partway through the command name
+                lines = (buffer + data).split("\n")
+                buffer = lines.pop()
+                if not any(buffer.startswith(prefix) or prefix.startswith(buffer) for prefix in LINE_COMMANDS):
+                    lines.append(buffer)
+                    buffer = ""
+                for command in lines:
+                    self.handle_command(client_socket, client_address, command.strip())
         except Exception as e:
             logger.error(f"Error handling client {client_address}: {e}")
         finally:
-            if client_socket in self.clients:
-                self.clients.remove(client_socket)
-            client_socket.close()
+            self.remove_client(client_socket)
+
+    def handle_command(self, client_socket, client_address, command):
+        if not command:
+            return
+
+        if command == "PAUSE":
+            self.set_broadcast_paused(True)
+            logger.info("Broadcast paused by client.")
+        elif command == "RESUME":
+            self.set_broadcast_paused(False)
+            logger.info("Broadcast resumed by client.")
+        elif command == "PING":
+            logger.debug(f"Received successful PING from client {client_address}")
+        elif command == "STATS":
+            self.send_message(client_socket, MSG_CONTROL, f"STATS:{json.dumps(self.send_stats())}\n".encode())
+        elif command.startswith("SUBSCRIBE:"):
+            try:
+                subscription = Subscription.from_message(command[len("SUBSCRIBE:"):])
+            except ValueError as e:
+                logger.warning(f"Invalid subscription from client {client_address}: {e}")
+                return
+            self.routes.update(client_socket, subscription)
+            logger.info(f"Client {client_address} updated its subscription: {subscription}")
+        elif command.startswith("CAPABILITIES:"):
+            if CLIP_CACHE_CAPABILITY in command[len("CAPABILITIES:"):].split(","):
+                self.enable_clip_cache(client_socket, client_address)
+        elif command.startswith("FETCH:"):
+            self.send_cached_clip(client_socket, client_address, command[len("FETCH:"):])
+        else:
+            logger.warning(f"Unknown command from client {client_address}: {command}")
+
+    def remove_client(self, client_socket):
+        if client_socket in self.clients:
+            self.clients.remove(client_socket)
+        self.routes.remove(client_socket)
+        writer = self.writers.pop(client_socket, None)
+        if writer:
+            writer.close()
+            self.retired_send_calls += writer.send_calls
+            self.retired_bytes_sent += writer.bytes_sent
+        # Writer threads drop clients while handle_client is still blocked in recv, which keeps the socket
+        # open past close(); shut it down so the client sees EOF and reconnects
+        try:
+            client_socket.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        client_socket.close()
+
+    def send_stats(self):
+        """Send syscalls made and bytes sent to clients since startup, for the load harness."""
+        writers = list(self.writers.values())
+        return {'send_calls': self.retired_send_calls + sum(writer.send_calls for writer in writers),
+                'bytes_sent': self.retired_bytes_sent + sum(writer.bytes_sent for writer in writers)}
+
+    def enable_clip_cache(self, client_socket, client_address):
+        """Switch the client to framed messages and offer it every clip so it can fill its cache."""
+        writer = self.writers.get(client_socket)
+        if writer is None:
+            return
+        with writer.lock:
+            writer.enqueue(FRAMED_MARKER)
+            writer.framed = True
+        self.routes.set_clip_cache(client_socket, True)
+        logger.info(f"Client {client_address} has a clip cache; alerts will be sent as clip IDs.")
+        self.send_message(client_socket, MSG_OFFER, json.dumps(self.clips.digests()).encode())
+
+    def send_cached_clip(self, client_socket, client_address, digest):
+        clip = self.clips.find(digest)
+        if clip is None:
+            # The clip may have been added since the last scan
+            self.clips.scan(self.audio_files_folder)
+            clip = self.clips.find(digest)
+        if clip is None:
+            logger.warning(f"Client {client_address} requested unknown clip {digest}")
+            return
+
+        logger.debug(f"Sending clip {digest} to client {client_address}")
+        header = MESSAGE_HEADER.pack(MSG_CLIP, len(clip.digest) + clip.size) + clip.digest.encode()
+        self.send_clip_region(client_socket, clip, 0, clip.size, header)
+
+    def send_message(self, client_socket, kind, payload):
+        """Queue one message, framed if the client has a clip cache and as the raw stream otherwise.
+
+        Returns False if the client has been dropped. Send errors surface on the client's writer thread.
+        """
+        writer = self.writers.get(client_socket)
+        if writer is None:
+            return False
+        with writer.lock:
+            if writer.framed:
+                return writer.enqueue(MESSAGE_HEADER.pack(kind, len(payload)), payload)
+            if kind == MSG_AUDIO:
+                return writer.enqueue(payload)
+            if kind == MSG_CONTROL:
+                return writer.enqueue(b"CONTROL:", payload)
+            return True
+
+    def send_clip_region(self, client_socket, clip, offset, count, header=b""):
+        writer = self.writers.get(client_socket)
+        if writer is None:
+            return False
+        with writer.lock:
+            if writer.framed and not header:
+                # The client switched to framing after this stream was routed to it
+                header = MESSAGE_HEADER.pack(MSG_AUDIO, count)
+            return writer.enqueue(header, FileRegion(clip, offset, count))
 
     def recv_with_reconnect(self, client_socket):
         try:
@@ -100,29 +263,132 @@ class AudioServer:
             self.clients.remove(client_socket)
             client_socket.close()
 
-    def broadcast_audio(self, chunk):
-        for client_socket in self.clients:
-            try:
-                client_socket.sendall(chunk)
-            except socket.error:
-                logger.error("Error broadcasting audio, removing client.")
-                self.clients.remove(client_socket)
-                client_socket.close()
+    def broadcast_audio(self, chunk, alert=None):
+        # Only clients whose subscription matches the alert are sent its audio; cached clients play clip IDs
+        recipients = self.routes.recipients(alert, clip_cache=False)
+        self.record_streaming(alert, recipients)
+        self.send_audio(recipients, chunk)
+
+    def send_audio(self, clients, chunk):
+        for client_socket in clients:
+            self.send_message(client_socket, MSG_AUDIO, chunk)
+
+    def submit_alert(self, alert, clip_paths, digests=()):
+        self.track_alert(alert, digests)
+        self.mixer.submit(alert, clip_paths)
+
+    def announce_alert(self, alert, digests):
+        """Tell clients with a clip cache which clips to play. They fetch any they are missing."""
+        record = self.track_alert(alert, digests)
+        if record:
+            record.stage("announced")
+        payload = json.dumps(digests).encode()
+        for client_socket in self.routes.recipients(alert, clip_cache=True):
+            self.send_message(client_socket, MSG_PLAY, payload)
+            writer = self.writers.get(client_socket)
+            if record and writer:
+                record.add_recipients([writer.client_address])
+                writer.enqueue_marker(partial(self.settle_delivery, record, writer.client_address, RESULT_ANNOUNCED))
+
+    def track_alert(self, alert, digests=None):
+        """The journal record for an alert, created the first time this server sees the alert."""
+        if not self.journal or alert is None or alert.incident_id is None:
+            return None
+        with self.records_lock:
+            record = self.alert_records.get(alert.incident_id)
+            if record is None:
+                record = AlertRecord(alert.incident_id, alert.priority, alert.incident_type, alert.detected_ns)
+                self.alert_records[alert.incident_id] = record
+        if digests and not record.clips:
+            record.clips = list(digests)
+        return record
+
+    def record_streaming(self, alert, clients):
+        record = self.track_alert(alert)
+        # Recipient sets are memoised, so this is normally the same set as for the previous chunk
+        if record is None or clients is record.last_clients:
+            return
+        record.last_clients = clients
+        if clients:
+            record.stage("streaming")
+        added = {}
+        for client_socket in clients:
+            writer = self.writers.get(client_socket)
+            if writer and client_socket not in record.clients:
+                added[client_socket] = writer.client_address
+        record.clients.update(added)
+        record.add_recipients(added.values())
+
+    def finish_alert(self, alert):
+        """Called once all of an alert's audio is queued. Each client's result settles when its writer gets this far."""
+        record = self.track_alert(alert)
+        if record is None:
+            return
+        record.stage("sent")
+        for client_socket, address in list(record.clients.items()):
+            callback = partial(self.settle_delivery, record, address, RESULT_STREAMED)
+            writer = self.writers.get(client_socket)
+            if writer:
+                writer.enqueue_marker(callback)
+            else:
+                callback(False)
+        self.complete_alert(record)
+
+    def settle_delivery(self, record, address, result, delivered):
+        record.settle(address, result if delivered else RESULT_FAILED)
+        self.complete_alert(record)
+
+    def complete_alert(self, record):
+        if record.finished():
+            with self.records_lock:
+                self.alert_records.pop(record.incident_id, None)
+            self.journal.submit(record)
+
+    def expire_alerts(self):
+        """Journal sent alerts whose slowest clients are still being sent them MAX_RECORD_AGE_NS after detection.
+
+        Time queries on the journal depend on records being written soon after detection.
+        """
+        deadline = time.time_ns() - MAX_RECORD_AGE_NS
+        with self.records_lock:
+            expired = [record for record in self.alert_records.values()
+                       if "sent" in record.stages and record.stages["detected"] < deadline]
+        for record in expired:
+            logger.warning(f"Alert {record.incident_id} has not reached every client in time; journaling it now")
+            record.expire()
+            self.complete_alert(record)
+
+    def sync_clips(self):
+        """Re-scan the audio folder and offer new or changed clips to clients with a clip cache."""
+        new_clips = self.clips.scan(self.audio_files_folder)
+        if not new_clips:
+            return
+
+        logger.info(f"Offering {len(new_clips)} new clips to cached clients")
+        payload = json.dumps([clip.digest for clip in new_clips]).encode()
+        for client_socket in list(self.routes.clip_cache_clients):
+            self.send_message(client_socket, MSG_OFFER, payload)
+
+    def set_broadcast_paused(self, paused):
+        self.broadcast_paused = paused
+        self.broadcast_control_message("PAUSED" if paused else "RESUMED")
+
+    def broadcast_clip(self, clip, offset, count, alert=None):
+        recipients = self.routes.recipients(alert, clip_cache=False)
+        self.record_streaming(alert, recipients)
+        for client_socket in recipients:
+            self.send_clip_region(client_socket, clip, offset, count)
 
     def broadcast_control_message(self, message):
-        control_message = f"CONTROL:{message}".encode()
-        for client_socket in self.clients:
-            try:
-                client_socket.sendall(control_message)
-            except socket.error:
-                logger.error("Error sending control message, removing client.")
-                self.clients.remove(client_socket)
-                client_socket.close()
+        for client_socket in list(self.clients):
+            self.send_message(client_socket, MSG_CONTROL, message.encode())
 
     def start_heartbeat(self):
         while not shutdown_event.is_set():
             time.sleep(self.heartbeat_interval)
             self.broadcast_control_message("HEARTBEAT")
+            if self.journal:
+                self.expire_alerts()
 
     def start(self):
         logger.info(f"Server listening on {self.host}:{self.port}")
@@ -130,32 +396,71 @@ class AudioServer:
             while not shutdown_event.is_set():
                 self.server_socket.settimeout(1.0)
                 try:
-                    client_socket, client_address = self.server_socket.accept()
-                    self.executor.submit(self.handle_client, client_socket, client_address)
+                    for client_socket, client_address in self.accept_batch():
+                        self.admission.offer(client_socket, client_address)
                 except socket.timeout:
                     continue
+                except OSError as e:
+                    # ECONNABORTED, EMFILE and the like concern one connection or pass; keep serving
+                    if shutdown_event.is_set():
+                        break
+                    logger.error(f"Error accepting connections: {e}")
+                    shutdown_event.wait(ACCEPT_ERROR_DELAY)
         finally:
             self.shutdown()
 
+    def accept_batch(self):
+        """Wait for one connection, then take any others already in the backlog, up to accept_batch."""
+        connections = [self.server_socket.accept()]
+        self.server_socket.setblocking(False)
+        try:
+            while len(connections) < self.admission_settings['accept_batch']:
+                connections.append(self.server_socket.accept())
+        except BlockingIOError:
+            pass
+        except OSError as e:
+            # Keep the connections already accepted; a persistent error shows up again on the next wait
+            logger.warning(f"Error accepting connections: {e}")
+        finally:
+            self.server_socket.settimeout(1.0)
+
+        for client_socket, _ in connections:
+            client_socket.setblocking(True)
+        return connections
+
     def shutdown(self):
         logger.info(f"Shutting down server...")
         shutdown_event.set()
 
         # Stop accepting new connections
         self.server_socket.close()
+        self.admission.close()
+
+        # Wake the client threads blocked in recv, or the pool below would wait for clients to hang up
+        for client_socket in list(self.clients):
+            try:
+                client_socket.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
 
         # Stop all threads in the thread pool
         self.executor.shutdown(wait=True)
 
         # Stop folder monitoring
-        self.observer.stop()
-        self.observer.join()
+        if self.observer:
+            self.observer.stop()
+            self.observer.join()
+        self.clips.close()
 
         # Close all connected clients
         for client_socket in self.clients:
             client_socket.close()
+        if self.journal:
+            self.journal.close()
 
         logger.info(f"Server shutdown complete.")
 
     def start_folder_monitor(self):
-        self.observer.start()
+        if self.observer:
+            self.clips.scan(self.audio_files_folder)
+            self.observer.start()
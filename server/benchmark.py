@@ -0,0 +1,270 @@
+import os
+import json
+import time
+import sys
+import socket
+import argparse
+import selectors
+import threading
+from pathlib import Path
+
+# Simulated stations reconnect with the client's own backoff
+sys.path.append(str(Path(__file__).resolve().parent.parent / "client"))
+from backoff import Backoff
+
+parser = argparse.ArgumentParser(description="RFAStream load harness: connects simulated stations and times an alert")
+parser.add_argument("--host", default="127.0.0.1", help="Server Hostname (Default: 127.0.0.1)")
+parser.add_argument("--port", type=int, default=12345, help="Server Port (Default: 12345)")
+parser.add_argument("--clients", type=int, default=100, help="Number of simulated stations (Default: 100)")
+parser.add_argument("--watchdog-folder", default="rfa", help="Server folder to drop the trigger .rfa file into")
+parser.add_argument("--incident", default="P1_tree_down", help="Priority and incident type to trigger (Default: P1_tree_down)")
+parser.add_argument("--idle", type=float, default=2.0, help="Seconds without data that mark an alert as finished")
+parser.add_argument("--timeout", type=float, default=120.0, help="Give up after this many seconds")
+parser.add_argument("--server-pid", type=int, action="append", default=[],
+                    help="Server process to sample CPU time from (Linux only, repeat for each worker)")
+parser.add_argument("--reconnect", action="store_true",
+                    help="Instead of triggering an alert, time how long the fleet takes to reconnect once the server is restarted")
+parser.add_argument("--reconnect-delay", type=float, default=5.0,
+                    help="Base reconnect delay of the simulated clients, as in the client config (Default: 5)")
+parser.add_argument("--max-reconnect-delay", type=float, default=60.0,
+                    help="Backoff cap of the simulated clients, as in the client config (Default: 60)")
+parser.add_argument("--label", default="", help="Tag for the results line, e.g. the server's streaming.chunk_size")
+
+
+class Station:
+    def __init__(self, sock):
+        self.sock = sock
+        self.bytes_received = 0
+        self.first_byte = None
+        self.last_byte = None
+
+
+def process_cpu_seconds(pids):
+    """Total user and system CPU time of the given processes, read from /proc."""
+    total_ticks = 0
+    for pid in pids:
+        with open(f"/proc/{pid}/stat") as stat_file:
+            # Fields after the parenthesised command name; utime and stime are the 12th and 13th
+            fields = stat_file.read().rsplit(")", 1)[1].split()
+        total_ticks += int(fields[11]) + int(fields[12])
+    return total_ticks / os.sysconf("SC_CLK_TCK")
+
+
+def connect_stations(host, port, count):
+    stations = []
+    for _ in range(count):
+        sock = socket.create_connection((host, port))
+        sock.setblocking(False)
+        stations.append(Station(sock))
+    return stations
+
+
+def drain(selector, timeout):
+    """Discard anything already queued (initial status, heartbeats) before the alert is triggered."""
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        for key, _ in selector.select(timeout=0.1):
+            try:
+                key.fileobj.recv(65536)
+            except BlockingIOError:
+                pass
+
+
+def query_send_stats(station, timeout=5.0):
+    """Ask the server for its send syscall and byte counters over one station's connection.
+
+    With several workers these are the counters of whichever worker accepted the station.
+    """
+    station.sock.setblocking(True)
+    station.sock.settimeout(timeout)
+    try:
+        station.sock.sendall(b"STATS")
+        data = b""
+        while True:
+            chunk = station.sock.recv(65536)
+            if not chunk:
+                return None
+            data += chunk
+            start = data.rfind(b"CONTROL:STATS:")
+            if start != -1 and b"\n" in data[start:]:
+                line = data[start + len(b"CONTROL:STATS:"):].split(b"\n", 1)[0]
+                return json.loads(line)
+    except (OSError, ValueError):
+        return None
+    finally:
+        station.sock.setblocking(False)
+
+
+def trigger_alert(watchdog_folder, incident):
+    rfa_path = Path(watchdog_folder) / f"{incident}_{time.time_ns()}.rfa"
+    rfa_path.write_text(f"Incident Detected: {incident}\n")
+    return rfa_path
+
+
+def receive_alert(selector, stations, idle, timeout):
+    started = time.monotonic()
+    last_activity = started
+    while True:
+        now = time.monotonic()
+        if now - started > timeout:
+            print("Timed out waiting for the alert to finish.")
+            break
+        if any(station.bytes_received for station in stations) and now - last_activity > idle:
+            break
+
+        for key, _ in selector.select(timeout=0.1):
+            station = key.data
+            try:
+                data = station.sock.recv(65536)
+            except BlockingIOError:
+                continue
+            except OSError:
+                selector.unregister(station.sock)
+                continue
+            if not data:
+                selector.unregister(station.sock)
+                continue
+            received_at = time.monotonic()
+            station.bytes_received += len(data)
+            station.first_byte = station.first_byte or received_at
+            station.last_byte = received_at
+            last_activity = received_at
+    return started
+
+
+def wait_for_disconnect(selector, stations, timeout):
+    """Wait until the server has closed every station's connection. Returns when the first one was closed."""
+    first_closed = None
+    remaining = len(stations)
+    deadline = time.monotonic() + timeout
+    while remaining and time.monotonic() < deadline:
+        for key, _ in selector.select(timeout=0.1):
+            try:
+                data = key.fileobj.recv(65536)
+            except BlockingIOError:
+                continue
+            except OSError:
+                data = b""
+            if not data:
+                selector.unregister(key.fileobj)
+                key.fileobj.close()
+                remaining -= 1
+                first_closed = first_closed or time.monotonic()
+    return first_closed
+
+
+def reconnect_station(host, port, backoff, deadline, disconnected_at, results):
+    """Reconnect the way client/audio.py does, with the client's own Backoff.
+
+    The first attempt after the drop waits a fully jittered delay. A failed connect, or a connection the
+    server closes before sending anything (turned away at admission), waits the next backoff delay; the
+    backoff is only reset once the server has sent a byte.
+    """
+    time.sleep(backoff.first_delay())
+    attempts = 0
+    while time.monotonic() < deadline:
+        attempts += 1
+        try:
+            sock = socket.create_connection((host, port), timeout=5)
+            # The server sends the broadcast state as soon as the handshake is admitted
+            sock.settimeout(max(deadline - time.monotonic(), 0.1))
+            admitted = sock.recv(1)
+            sock.close()
+            if admitted:
+                backoff.reset()
+                results.append((time.monotonic() - disconnected_at, attempts))
+                return
+        except OSError:
+            pass
+        time.sleep(backoff.next_delay())
+
+
+def measure_reconnect(args, selector, stations):
+    print("Restart the server now; waiting for it to drop the stations...")
+    disconnected_at = wait_for_disconnect(selector, stations, args.timeout)
+    if disconnected_at is None:
+        print("The server did not drop any station.")
+        return
+    print("Server went away; reconnecting the fleet")
+
+    results = []
+    deadline = disconnected_at + args.timeout
+    threads = [threading.Thread(target=reconnect_station, daemon=True,
+                                args=(args.host, args.port, Backoff(args.reconnect_delay, args.max_reconnect_delay),
+                                      deadline, disconnected_at, results))
+               for _ in stations]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(max(deadline - time.monotonic(), 0))
+
+    if not results:
+        print("No station reconnected.")
+        return
+    times = sorted(elapsed for elapsed, _ in results)
+    attempts = sum(count for _, count in results)
+    print(f"Stations reconnected: {len(results)}/{len(stations)}")
+    print(f"Fleet reconnect time: p50 {times[len(times) // 2]:.2f} s, p95 {times[int(len(times) * 0.95)]:.2f} s, "
+          f"all {times[-1]:.2f} s ({attempts / len(results):.1f} connection attempts per station)")
+    if args.label:
+        print(f"[{args.label}] reconnect p50 {times[len(times) // 2]:.3f} s, all {times[-1]:.3f} s, "
+              f"{len(results)}/{len(stations)} stations")
+
+
+def report(stations, started, cpu_seconds=None, send_stats=None, label=""):
+    delivered = [station for station in stations if station.bytes_received]
+    if not delivered:
+        print("No station received any audio.")
+        return
+
+    total_bytes = sum(station.bytes_received for station in delivered)
+    completion = sorted(station.last_byte - started for station in delivered)
+    elapsed = completion[-1]
+    print(f"Stations receiving audio: {len(delivered)}/{len(stations)}")
+    print(f"Total received: {total_bytes / 1e6:.2f} MB in {elapsed:.2f} s ({total_bytes / 1e6 / elapsed:.2f} MB/s)")
+    print(f"Alert completion: p50 {completion[len(completion) // 2]:.2f} s, "
+          f"p95 {completion[int(len(completion) * 0.95)]:.2f} s, max {elapsed:.2f} s")
+    if cpu_seconds is not None:
+        print(f"Server CPU: {cpu_seconds:.2f} s ({cpu_seconds * 1000 / (total_bytes / 1e6):.1f} ms per MB sent)")
+    if send_stats:
+        calls, sent = send_stats
+        print(f"Server send syscalls: {calls} for {sent / 1e6:.2f} MB "
+              f"({calls / len(delivered):.1f} per station, {sent / max(calls, 1) / 1024:.1f} KiB per call)")
+    if label:
+        print(f"[{label}] p50 {completion[len(completion) // 2]:.3f} s, max {elapsed:.3f} s"
+              + (f", {send_stats[0]} send calls" if send_stats else ""))
+
+
+def main():
+    args = parser.parse_args()
+
+    stations = connect_stations(args.host, args.port, args.clients)
+    selector = selectors.DefaultSelector()
+    for station in stations:
+        selector.register(station.sock, selectors.EVENT_READ, station)
+    print(f"Connected {len(stations)} stations to {args.host}:{args.port}")
+
+    drain(selector, 1.0)
+    if args.reconnect:
+        measure_reconnect(args, selector, stations)
+        return
+
+    stats_before = query_send_stats(stations[0])
+    cpu_before = process_cpu_seconds(args.server_pid) if args.server_pid else None
+    rfa_path = trigger_alert(args.watchdog_folder, args.incident)
+    print(f"Triggered {rfa_path.name}")
+    started = receive_alert(selector, stations, args.idle, args.timeout)
+    cpu_seconds = process_cpu_seconds(args.server_pid) - cpu_before if args.server_pid else None
+    stats_after = query_send_stats(stations[0])
+    send_stats = None
+    if stats_before and stats_after:
+        send_stats = (stats_after['send_calls'] - stats_before['send_calls'],
+                      stats_after['bytes_sent'] - stats_before['bytes_sent'])
+    report(stations, started, cpu_seconds, send_stats, args.label)
+
+    for station in stations:
+        station.sock.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,153 @@
+import os
+import wave
+import tempfile
+import hashlib
+import numpy as np
+from pathlib import Path
+from loguru import logger
+
+# Canonical stream format the client plays: 44.1 kHz, mono, signed 16-bit little-endian PCM
+STREAM_RATE = 44100
+STREAM_CHANNELS = 1
+STREAM_SAMPLE_WIDTH = 2
+
+# Bump when the processing below changes so existing cache entries are not reused
+PREP_VERSION = 1
+
+# Loudness normalization never pushes peaks above this (dBFS)
+PEAK_CEILING_DB = -1.0
+
+# Silence kept either side of the trimmed clip, in seconds
+TRIM_PADDING = 0.01
+
+
+def read_wav(path):
+    """Return (samples, rate) with samples as float32 in [-1, 1], shaped (frames, channels)."""
+    with wave.open(str(path), 'rb') as wav_file:
+        channels = wav_file.getnchannels()
+        sample_width = wav_file.getsampwidth()
+        rate = wav_file.getframerate()
+        raw = wav_file.readframes(wav_file.getnframes())
+
+    if sample_width == 1:
+        samples = (np.frombuffer(raw, dtype=np.uint8).astype(np.float32) - 128) / 128
+    elif sample_width == 2:
+        samples = np.frombuffer(raw, dtype='<i2').astype(np.float32) / 2 ** 15
+    elif sample_width == 3:
+        # Widen packed 24-bit samples to int32, then sign-extend with an arithmetic shift
+        packed = np.frombuffer(raw, dtype=np.uint8).reshape(-1, 3).astype(np.int32)
+        widened = packed[:, 0] | (packed[:, 1] << 8) | (packed[:, 2] << 16)
+        samples = ((widened << 8) >> 8).astype(np.float32) / 2 ** 23
+    elif sample_width == 4:
+        samples = np.frombuffer(raw, dtype='<i4').astype(np.float32) / 2 ** 31
+    else:
+        raise ValueError(f"Unsupported sample width: {sample_width} bytes")
+
+    return samples.reshape(-1, channels), rate
+
+
+def downmix(samples):
+    return samples.mean(axis=1)
+
+
+def resample(samples, rate, target_rate):
+    """Linear-interpolation resampler, low-pass filtered first when downsampling to avoid aliasing."""
+    if rate == target_rate or not len(samples):
+        return samples
+
+    if target_rate < rate:
+        cutoff = target_rate / rate / 2
+        taps = np.arange(-32, 33)
+        kernel = np.sinc(2 * cutoff * taps) * np.hamming(len(taps))
+        samples = np.convolve(samples, kernel / kernel.sum(), mode="same")
+
+    target_length = int(round(len(samples) * target_rate / rate))
+    positions = np.arange(target_length) * (rate / target_rate)
+    return np.interp(positions, np.arange(len(samples)), samples).astype(np.float32)
+
+
+def trim_silence(samples, threshold_db, rate):
+    loud = np.flatnonzero(np.abs(samples) > 10 ** (threshold_db / 20))
+    if not len(loud):
+        return samples
+
+    padding = int(rate * TRIM_PADDING)
+    return samples[max(loud[0] - padding, 0):loud[-1] + padding + 1]
+
+
+def normalize(samples, mode, target_db):
+    """Scale to a peak ("peak") or RMS ("rms") level in dBFS. Any other mode leaves the clip untouched."""
+    peak = np.max(np.abs(samples)) if len(samples) else 0
+    if mode not in ("peak", "rms") or peak == 0:
+        return samples
+
+    if mode == "peak":
+        gain = 10 ** (target_db / 20) / peak
+    else:
+        rms = np.sqrt(np.mean(np.square(samples, dtype=np.float64)))
+        gain = min(10 ** (target_db / 20) / rms, 10 ** (PEAK_CEILING_DB / 20) / peak)
+    return samples * np.float32(gain)
+
+
+def to_pcm16(samples):
+    return np.clip(np.round(samples * 2 ** 15), -2 ** 15, 2 ** 15 - 1).astype('<i2').tobytes()
+
+
+class ClipPreparer:
+    """Converts clips to the canonical stream format once and caches the result by content hash.
+
+    The cache key covers the source file's bytes and the preparation settings, so an unchanged clip
+    is only ever processed once, across restarts, and a changed clip or setting is processed again.
+    """
+
+    def __init__(self, cache_folder, normalize="peak", target_db=-1.0, trim_silence_db=-50.0):
+        self.cache_folder = Path(cache_folder)
+        self.normalize = normalize
+        self.target_db = target_db
+        self.trim_silence_db = trim_silence_db
+        self.cache_folder.mkdir(parents=True, exist_ok=True)
+
+    def cache_key(self, source_bytes):
+        digest = hashlib.sha256()
+        digest.update(f"{PREP_VERSION}:{self.normalize}:{self.target_db}:{self.trim_silence_db}:".encode())
+        digest.update(source_bytes)
+        return digest.hexdigest()
+
+    def prepare(self, source_path):
+        """Return the path of the prepared PCM for source_path, processing it if it is not cached yet."""
+        with open(source_path, 'rb') as source_file:
+            key = self.cache_key(source_file.read())
+        prepared_path = self.cache_folder / f"{key}.pcm"
+        if prepared_path.exists():
+            return prepared_path
+
+        try:
+            samples, rate = read_wav(source_path)
+        except (wave.Error, EOFError, ValueError) as e:
+            logger.error(f"Could not prepare {source_path}, streaming it unprocessed: {e}")
+            return Path(source_path)
+
+        samples = resample(downmix(samples), rate, STREAM_RATE)
+        if self.trim_silence_db is not None:
+            samples = trim_silence(samples, self.trim_silence_db, STREAM_RATE)
+        samples = normalize(samples, self.normalize, self.target_db)
+
+        # Write to a unique temporary file first so a crash never leaves a truncated cache entry and
+        # concurrent preparations of the same clip never write to the same file
+        with tempfile.NamedTemporaryFile(dir=self.cache_folder, prefix=f"{key}.", suffix=".tmp",
+                                         delete=False) as temp_file:
+            temp_file.write(to_pcm16(samples))
+        os.replace(temp_file.name, prepared_path)
+        logger.info(f"Prepared {source_path} ({rate} Hz) as {prepared_path.name}")
+        return prepared_path
+
+    def evict(self, prepared_path):
+        """Delete a cache entry whose source has changed. Paths outside the cache folder are left alone."""
+        prepared_path = Path(prepared_path)
+        if prepared_path.parent != self.cache_folder or prepared_path.suffix != ".pcm":
+            return
+        try:
+            prepared_path.unlink()
+            logger.debug(f"Evicted stale prepared clip {prepared_path.name}")
+        except FileNotFoundError:
+            pass
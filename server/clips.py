@@ -0,0 +1,123 @@
+import os
+import mmap
+import hashlib
+import threading
+from pathlib import Path
+from loguru import logger
+
+
+class Clip:
+    """A memory-mapped audio file. Slices of `view` and the open `file` are shared by every send.
+
+    `digest` is the SHA-256 of the mapped bytes and identifies the clip in client caches.
+    """
+
+    def __init__(self, path, prepared=False):
+        self.path = str(path)
+        self.prepared = prepared  # True once converted to the canonical stream format
+        self.file = open(path, 'rb')
+        self.size = os.fstat(self.file.fileno()).st_size
+        # mmap refuses empty files, so an empty clip gets an empty view
+        self.mmap = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ) if self.size else None
+        self.view = memoryview(self.mmap) if self.mmap else memoryview(b"")
+        self.digest = hashlib.sha256(self.view).hexdigest()
+        # The ClipStore holds one reference; every send still using the file holds another
+        self.references = 1
+        self.lock = threading.Lock()
+
+    def chunks(self, chunk_size):
+        for offset in range(0, self.size, chunk_size):
+            yield offset, min(chunk_size, self.size - offset)
+
+    def retain(self):
+        """Keep the clip open until a matching close(). Returns False if it has already been closed."""
+        with self.lock:
+            if not self.references:
+                return False
+            self.references += 1
+            return True
+
+    def close(self):
+        """Drop a reference; the file and mapping are closed once the last one is dropped."""
+        with self.lock:
+            self.references -= 1
+            if self.references:
+                return
+        self.file.close()
+        try:
+            self.view.release()
+            if self.mmap:
+                self.mmap.close()
+        except BufferError:
+            # A slice is still referenced elsewhere; the mapping is released with it
+            pass
+
+
+class ClipStore:
+    """Keeps clips mapped between alerts and remaps them when the source file on disk changes.
+
+    With a preparer, the mapped file is the source converted to the canonical stream format.
+    """
+
+    def __init__(self, preparer=None):
+        self.preparer = preparer
+        self.clips = {}  # source path -> ((mtime_ns, size), Clip)
+        self.by_digest = {}
+        self.lock = threading.RLock()
+
+    def get(self, path):
+        key = str(path)
+        stat = os.stat(key)
+        signature = (stat.st_mtime_ns, stat.st_size)
+        with self.lock:
+            cached = self.clips.get(key)
+            if cached and cached[0] == signature:
+                return cached[1]
+
+            if cached:
+                logger.debug(f"Audio file changed on disk, remapping: {key}")
+                if self.by_digest.get(cached[1].digest) is cached[1]:
+                    del self.by_digest[cached[1].digest]
+                cached[1].close()
+
+            # The preparer hands back the source itself when it cannot convert it
+            path_to_map = self.preparer.prepare(key) if self.preparer else key
+            clip = Clip(path_to_map, prepared=Path(path_to_map) != Path(key))
+            self.clips[key] = (signature, clip)
+            self.by_digest[clip.digest] = clip
+            if cached and self.preparer and cached[1].path != clip.path:
+                # The old prepared file is keyed by the old content; drop it unless another clip still maps it
+                if all(other.path != cached[1].path for _, other in self.clips.values()):
+                    self.preparer.evict(cached[1].path)
+            return clip
+
+    def acquire(self, path):
+        """Like get(), but the clip stays open until the caller closes it, even if it is remapped meanwhile."""
+        with self.lock:
+            clip = self.get(path)
+            clip.retain()
+            return clip
+
+    def find(self, digest):
+        with self.lock:
+            return self.by_digest.get(digest)
+
+    def digests(self):
+        with self.lock:
+            return list(self.by_digest)
+
+    def scan(self, audio_files_folder):
+        """Map (and prepare) every clip in the folder. Returns the clips whose content is new."""
+        with self.lock:
+            known = set(self.by_digest)
+            for path in sorted(Path(audio_files_folder).glob("*.wav")):
+                try:
+                    self.get(path)
+                except FileNotFoundError:
+                    continue
+            return [clip for digest, clip in self.by_digest.items() if digest not in known]
+
+    def close(self):
+        for _, clip in self.clips.values():
+            clip.close()
+        self.clips.clear()
@@ -9,7 +9,37 @@ def load_config(config_path='server-config.json'):
         'host': '0.0.0.0',
         'port': 12345,
         'watchdog_folder': 'rfa',
-        'audio_files': 'wav-files'
+        'audio_files': 'wav-files',
+        'workers': 1,
+        'alert_groups': {},
+        'clip_preparation': {
+            'cache_folder': 'clip-cache',
+            'normalize': 'peak',
+            'target_db': -1.0,
+            'trim_silence_db': -50.0
+        },
+        'mixing': None,
+        'streaming': {
+            'chunk_size': 65536,
+            'send_buffer': 262144,
+            'tcp_nodelay': True,
+            'tcp_cork': False,
+            'max_batch': 65536,
+            'max_pending': 8388608,
+            'stall_timeout': 30.0
+        },
+        'admission': {
+            'backlog': 1024,
+            'accept_batch': 64,
+            'handshake_rate': 50.0,
+            'handshake_burst': 100,
+            'max_pending': 2048,
+            'max_clients': 1000,
+            'known_stations_file': 'known-stations.json'
+        },
+        'journal': {
+            'folder': 'journal'
+        }
     }
 
     # Check if the config file exists
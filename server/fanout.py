@@ -0,0 +1,320 @@
+import os
+import time
+import json
+import socket
+import struct
+import multiprocessing
+import threading
+from multiprocessing import shared_memory
+from pathlib import Path
+from loguru import logger
+from watchdog.observers import Observer
+from audio_server import AudioServer, shutdown_event
+from watchdog_monitor import FileHandler, ClipSyncHandler
+from routing import Alert
+from clips import ClipStore
+from clip_prep import ClipPreparer
+from writer import DEFAULT_STREAMING
+
+FRAME_AUDIO = 1
+FRAME_CONTROL = 2
+FRAME_ALERT = 3
+FRAME_PLAY = 4
+FRAME_SYNC = 5
+FRAME_DONE = 6
+
+# Slot sequence value written while a slot is being overwritten
+INVALID_SEQ = 2 ** 64 - 1
+
+# Cursor value of a reader that has not attached yet, or that the publisher stopped waiting for
+DETACHED = 2 ** 64 - 1
+
+
+class FrameRing:
+    """Shared-memory ring of fixed-size frame slots.
+
+    Writers (the dispatcher, and workers publishing pause changes) serialise on the ring's condition.
+    Every worker reads the same slots independently and keeps its cursor in the ring, and a writer waits
+    for the slowest attached reader before reusing a slot, so audio is not dropped when a worker falls
+    behind. A reader stalled for longer than stall_timeout is detached instead of holding up the rest;
+    it then skips ahead to the oldest frame still available. Each slot can carry a short tag (the
+    encoded alert) ahead of its payload.
+    """
+
+    HEADER = struct.Struct("<Q")  # next sequence number to be written
+    CURSOR = struct.Struct("<Q")  # next sequence number each reader will read
+    SLOT_HEADER = struct.Struct("<QBHI")  # sequence, frame kind, tag length, payload length
+
+    def __init__(self, readers, slots=2048, slot_size=16384, stall_timeout=5.0):
+        self.readers = readers
+        self.slots = slots
+        self.slot_size = slot_size
+        self.slot_stride = self.SLOT_HEADER.size + slot_size
+        self.stall_timeout = stall_timeout
+        self.slots_offset = self.HEADER.size + readers * self.CURSOR.size
+        self.condition = multiprocessing.Condition()
+        self.shm = shared_memory.SharedMemory(create=True, size=self.slots_offset + slots * self.slot_stride)
+        self.HEADER.pack_into(self.shm.buf, 0, 0)
+        for reader in range(readers):
+            self.set_cursor(reader, DETACHED)
+        self.owner_pid = os.getpid()
+
+    def head(self):
+        return self.HEADER.unpack_from(self.shm.buf, 0)[0]
+
+    def cursor(self, reader):
+        return self.CURSOR.unpack_from(self.shm.buf, self.HEADER.size + reader * self.CURSOR.size)[0]
+
+    def set_cursor(self, reader, seq):
+        self.CURSOR.pack_into(self.shm.buf, self.HEADER.size + reader * self.CURSOR.size, seq)
+
+    def attach(self, reader):
+        """Start reading as reader from the next frame published. Returns that frame's sequence number."""
+        with self.condition:
+            head = self.head()
+            self.set_cursor(reader, head)
+            return head
+
+    def wait_for_readers(self, seq):
+        """Block (holding the condition) until no attached reader still needs the slot seq will overwrite."""
+        deadline = None
+        while True:
+            lagging = [reader for reader in range(self.readers)
+                       if self.cursor(reader) != DETACHED and seq - self.cursor(reader) >= self.slots]
+            if not lagging:
+                return
+            deadline = deadline or time.monotonic() + self.stall_timeout
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                for reader in lagging:
+                    logger.warning(f"Worker {reader} has not read for {self.stall_timeout} s. No longer waiting for it.")
+                    self.set_cursor(reader, DETACHED)
+                return
+            self.condition.wait(remaining)
+
+    def publish(self, kind, payload, tag=b""):
+        payload = memoryview(payload).cast("B")
+        piece_size = self.slot_size - len(tag)
+        buf = self.shm.buf
+        with self.condition:
+            seq = self.head()
+            # Payloads larger than a slot are split; only audio frames are ever that large
+            for start in range(0, max(len(payload), 1), piece_size):
+                self.wait_for_readers(seq)
+                piece = payload[start:start + piece_size]
+                offset = self.slots_offset + (seq % self.slots) * self.slot_stride
+                body = offset + self.SLOT_HEADER.size
+                self.SLOT_HEADER.pack_into(buf, offset, INVALID_SEQ, kind, 0, 0)
+                buf[body:body + len(tag)] = tag
+                buf[body + len(tag):body + len(tag) + len(piece)] = piece
+                self.SLOT_HEADER.pack_into(buf, offset, seq, kind, len(tag), len(piece))
+                seq += 1
+                self.HEADER.pack_into(buf, 0, seq)
+            self.condition.notify_all()
+
+    def read(self, reader, next_seq, timeout=1.0):
+        """Return (next_seq, frames) for every (kind, tag, payload) published since next_seq, waiting up to timeout."""
+        with self.condition:
+            if self.cursor(reader) == DETACHED:
+                # Attach again; anything older than one ring may already have been overwritten
+                self.set_cursor(reader, max(next_seq, self.head() - self.slots))
+            if self.head() == next_seq:
+                self.condition.wait(timeout)
+        head = self.head()
+        if head - next_seq > self.slots:
+            logger.warning(f"Worker fell {head - next_seq - self.slots} frames behind the dispatcher. Skipping ahead.")
+            next_seq = head - self.slots
+
+        buf = self.shm.buf
+        frames = []
+        for seq in range(next_seq, head):
+            offset = self.slots_offset + (seq % self.slots) * self.slot_stride
+            body = offset + self.SLOT_HEADER.size
+            slot_seq, kind, tag_length, length = self.SLOT_HEADER.unpack_from(buf, offset)
+            tag = bytes(buf[body:body + tag_length])
+            payload = bytes(buf[body + tag_length:body + tag_length + length])
+            # The slot may have been recycled while it was being copied
+            if slot_seq != seq or self.SLOT_HEADER.unpack_from(buf, offset)[0] != seq:
+                logger.warning(f"Frame {seq} was overwritten before it could be read. Dropping it.")
+                continue
+            frames.append((kind, tag, payload))
+
+        # Free the slots just read and wake a writer waiting for them
+        with self.condition:
+            self.set_cursor(reader, head)
+            self.condition.notify_all()
+        return head, frames
+
+    def close(self):
+        self.shm.close()
+        if os.getpid() == self.owner_pid:
+            self.shm.unlink()
+            self.owner_pid = None
+
+
+class WorkerAudioServer(AudioServer):
+    """AudioServer that relays frames from the dispatcher's ring instead of monitoring folders itself."""
+
+    def __init__(self, ring, reader, pause_state, host, port, watchdog_folder, audio_files_folder,
+                 clip_preparation=None, mixing=None, streaming=None, admission=None, journal=None):
+        self.ring = ring
+        self.reader = reader
+        self.pause_state = pause_state
+        super().__init__(host, port, watchdog_folder, audio_files_folder, reuse_port=True, monitor_folder=False,
+                         clip_preparation=clip_preparation, mixing=mixing, streaming=streaming,
+                         admission=admission, journal=journal)
+        # The dispatcher has already prepared the clips, so this only maps them for serving fetches
+        self.clips.scan(self.audio_files_folder)
+
+        self.relay_thread = threading.Thread(target=self.relay_frames, daemon=True)
+        self.relay_thread.start()
+
+    @property
+    def broadcast_paused(self):
+        return bool(self.pause_state.value)
+
+    @broadcast_paused.setter
+    def broadcast_paused(self, paused):
+        self.pause_state.value = paused
+
+    def set_broadcast_paused(self, paused):
+        # Publish through the ring so clients on every worker are told, not just this one's
+        self.broadcast_paused = paused
+        self.ring.publish(FRAME_CONTROL, ("PAUSED" if paused else "RESUMED").encode())
+
+    def relay_frames(self):
+        next_seq = self.ring.attach(self.reader)
+        alerts = {b"": None}
+        while not shutdown_event.is_set():
+            next_seq, frames = self.ring.read(self.reader, next_seq)
+            for kind, tag, payload in frames:
+                if kind == FRAME_AUDIO:
+                    # Routing is per worker, since each worker only knows its own clients' subscriptions
+                    if tag not in alerts:
+                        alerts[tag] = Alert.decode(tag)
+                    self.broadcast_audio(payload, alerts[tag])
+                elif kind == FRAME_ALERT:
+                    # Each worker mixes for its own clients from the clips the dispatcher prepared
+                    clip_paths, digests = json.loads(payload)
+                    self.submit_alert(Alert.decode(tag), clip_paths, digests)
+                elif kind == FRAME_PLAY:
+                    self.announce_alert(Alert.decode(tag), json.loads(payload))
+                elif kind == FRAME_DONE:
+                    self.finish_alert(alerts.pop(tag, None) or Alert.decode(tag))
+                elif kind == FRAME_SYNC:
+                    self.sync_clips()
+                elif kind == FRAME_CONTROL:
+                    self.broadcast_control_message(payload.decode())
+
+
+def run_worker(ring, reader, pause_state, host, port, watchdog_folder, audio_files_folder, clip_preparation, mixing,
+               streaming, admission, journal):
+    logger.info(f"Audio worker {os.getpid()} starting.")
+    server = WorkerAudioServer(ring, reader, pause_state, host, port, watchdog_folder, audio_files_folder,
+                               clip_preparation, mixing, streaming, admission, journal)
+    server.start()
+
+
+class FanoutDispatcher:
+    """Monitors the watchdog folder and publishes alert audio to a pool of worker processes.
+
+    Each worker runs its own WorkerAudioServer bound to the same port with SO_REUSEPORT, so client
+    connections and per-client sends are spread across cores rather than sharing one GIL.
+    """
+
+    def __init__(self, host, port, watchdog_folder, audio_files_folder, workers, alert_groups=None,
+                 clip_preparation=None, mixing=None, streaming=None, admission=None, journal=None):
+        if not hasattr(socket, "SO_REUSEPORT"):
+            raise RuntimeError("Multi-worker mode requires SO_REUSEPORT, which this platform does not support.")
+
+        self.host = host
+        self.port = port
+        self.watchdog_folder = Path(watchdog_folder)
+        self.audio_files_folder = Path(audio_files_folder)
+        self.ring = FrameRing(workers)
+        self.pause_state = multiprocessing.Value('b', False)
+
+        # Initialize folder monitoring (watchdog)
+        self.observer = Observer()
+        self.clips = ClipStore(ClipPreparer(**clip_preparation) if clip_preparation else None)
+        chunk_size = {**DEFAULT_STREAMING, **(streaming or {})}['chunk_size']
+        self.event_handler = FileHandler(self, self.audio_files_folder, alert_groups, self.clips, mixing is not None,
+                                         chunk_size)
+        self.observer.schedule(self.event_handler, self.watchdog_folder, recursive=False)
+        self.observer.schedule(ClipSyncHandler(self), self.audio_files_folder, recursive=False)
+
+        # Each worker journals deliveries to its own clients, in its own folder under the journal folder
+        self.processes = [
+            multiprocessing.Process(target=run_worker, name=f"audio-worker-{index}", daemon=True,
+                                    args=(self.ring, index, self.pause_state, host, port, watchdog_folder,
+                                          audio_files_folder, clip_preparation, mixing, streaming, admission,
+                                          {**journal, 'folder': str(Path(journal['folder']) / f"worker-{index}")}
+                                          if journal else None))
+            for index in range(workers)
+        ]
+
+    @property
+    def broadcast_paused(self):
+        return bool(self.pause_state.value)
+
+    def broadcast_audio(self, chunk, alert=None):
+        self.ring.publish(FRAME_AUDIO, chunk, alert.encode() if alert else b"")
+
+    def broadcast_clip(self, clip, offset, count, alert=None):
+        # The slice is copied once into shared memory, however many workers and clients read it
+        self.ring.publish(FRAME_AUDIO, clip.view[offset:offset + count], alert.encode() if alert else b"")
+
+    def broadcast_control_message(self, message):
+        self.ring.publish(FRAME_CONTROL, message.encode())
+
+    def submit_alert(self, alert, clip_paths, digests=()):
+        payload = json.dumps([[str(path) for path in clip_paths], list(digests)]).encode()
+        self.ring.publish(FRAME_ALERT, payload, alert.encode())
+
+    def announce_alert(self, alert, digests):
+        self.ring.publish(FRAME_PLAY, json.dumps(digests).encode(), alert.encode())
+
+    def finish_alert(self, alert):
+        self.ring.publish(FRAME_DONE, b"", alert.encode())
+
+    def sync_clips(self):
+        # Prepare changed clips here once, then have every worker pick them up and offer them
+        if self.clips.scan(self.audio_files_folder):
+            self.ring.publish(FRAME_SYNC, b"")
+
+    def start_folder_monitor(self):
+        self.clips.scan(self.audio_files_folder)
+        self.observer.start()
+
+    def start(self):
+        logger.info(f"Starting {len(self.processes)} audio workers on {self.host}:{self.port}")
+        for process in self.processes:
+            process.start()
+
+        try:
+            while not shutdown_event.is_set():
+                shutdown_event.wait(1.0)
+                for process in self.processes:
+                    if not process.is_alive():
+                        logger.error(f"Audio worker {process.name} exited with code {process.exitcode}.")
+                        shutdown_event.set()
+        finally:
+            self.shutdown()
+
+    def shutdown(self):
+        logger.info(f"Shutting down dispatcher...")
+        shutdown_event.set()
+
+        # Stop folder monitoring
+        if self.observer.is_alive():
+            self.observer.stop()
+            self.observer.join()
+        self.clips.close()
+
+        for process in self.processes:
+            if process.is_alive():
+                process.terminate()
+            process.join(timeout=5)
+
+        self.ring.close()
+        logger.info(f"Dispatcher shutdown complete.")
@@ -0,0 +1,497 @@
+import os
+import json
+import mmap
+import time
+import queue
+import struct
+import hashlib
+import zlib
+import argparse
+import threading
+from datetime import datetime
+from pathlib import Path
+from loguru import logger
+
+JOURNAL_NAME = "alerts.jnl"
+TIME_INDEX_NAME = "time.idx"
+INCIDENT_INDEX_NAME = "incident.idx"
+
+MAGIC = b"RFAJ"
+RECORD_HEADER = struct.Struct("<4sII")  # magic, body length, CRC-32 of the body
+TIME_ENTRY = struct.Struct("<QQQ")  # detected time (ns), journal offset, incident hash
+INCIDENT_HEADER = struct.Struct("<QQ")  # slot count, time index entries inserted so far
+INCIDENT_SLOT = struct.Struct("<QQ")  # incident hash, time index entry number + 1 (0 marks an empty slot)
+INITIAL_INCIDENT_SLOTS = 4096
+
+# Records are indexed by detection time but written on completion, so concurrent alerts can be slightly
+# out of order; time queries look this far either side of the requested range
+INDEX_SKEW_NS = 15 * 60 * 10 ** 9
+
+# The server settles deliveries still in flight this long after detection, keeping every record well
+# within INDEX_SKEW_NS of the records around it
+MAX_RECORD_AGE_NS = 5 * 60 * 10 ** 9
+
+STAGES = ("detected", "announced", "streaming", "sent", "delivered")
+RESULT_STREAMED = 1  # Every byte of the alert's audio was handed to the client's socket
+RESULT_ANNOUNCED = 2  # The clip IDs were handed to a client with a clip cache
+RESULT_FAILED = 3  # The client disconnected before the alert reached it
+RESULT_EXPIRED = 4  # The client was still being sent the alert MAX_RECORD_AGE_NS after detection
+RESULT_NAMES = {RESULT_STREAMED: "streamed", RESULT_ANNOUNCED: "announced", RESULT_FAILED: "failed",
+                RESULT_EXPIRED: "expired"}
+
+
+def incident_hash(incident_id):
+    # Zero marks an empty slot in the incident index, so never hash to it
+    return int.from_bytes(hashlib.blake2b(incident_id.encode(), digest_size=8).digest(), "little") or 1
+
+
+class AlertRecord:
+    """What happened to one alert: its clips, when each stage was reached and the result for each recipient.
+
+    Recipients are settled by their ClientWriter once the alert has been written to their socket (or the
+    client is dropped), and the record is handed to the journal when the last one settles.
+    """
+
+    def __init__(self, incident_id, priority, incident_type, detected_ns=None):
+        self.incident_id = incident_id
+        self.priority = priority
+        self.incident_type = incident_type
+        self.clips = []
+        self.stages = {"detected": detected_ns or time.time_ns()}
+        self.recipients = {}  # Client address -> result once known, None while in flight
+        self.deliveries = []  # (host, port, result, time_ns)
+        self.clients = {}  # Sockets the audio was streamed to -> their address; not journaled
+        self.last_clients = None
+        self.done = False
+        self.lock = threading.Lock()
+
+    def stage(self, name):
+        self.stages.setdefault(name, time.time_ns())
+
+    def add_recipients(self, addresses):
+        with self.lock:
+            for address in addresses:
+                self.recipients.setdefault(address, None)
+
+    def settle(self, address, result):
+        with self.lock:
+            if self.recipients.get(address) is None:
+                self.recipients[address] = result
+                self.deliveries.append((address[0], address[1], result, time.time_ns()))
+
+    def expire(self):
+        """Settle every recipient still in flight as expired."""
+        with self.lock:
+            pending = [address for address, result in self.recipients.items() if result is None]
+        for address in pending:
+            self.settle(address, RESULT_EXPIRED)
+
+    def finished(self):
+        """True exactly once: when the alert has been fully sent and every recipient has a result."""
+        with self.lock:
+            if self.done or "sent" not in self.stages or None in self.recipients.values():
+                return False
+            self.done = True
+            self.stages.setdefault("delivered", time.time_ns())
+            return True
+
+    def encode(self):
+        body = [struct.pack("<Q", self.stages["detected"])]
+        for text in (self.incident_id, self.priority, self.incident_type):
+            data = text.encode()
+            body.append(struct.pack("<H", len(data)) + data)
+        body.append(struct.pack("<B", len(self.clips)) + b"".join(bytes.fromhex(digest) for digest in self.clips))
+        stages = [(STAGES.index(name), ns) for name, ns in self.stages.items() if name in STAGES]
+        body.append(struct.pack("<B", len(stages)) + b"".join(struct.pack("<BQ", *stage) for stage in stages))
+        body.append(struct.pack("<I", len(self.deliveries)))
+        for host, port, result, ns in self.deliveries:
+            data = str(host).encode()
+            body.append(struct.pack("<B", len(data)) + data + struct.pack("<HBQ", port, result, ns))
+        return b"".join(body)
+
+    @classmethod
+    def decode(cls, body):
+        detected_ns, = struct.unpack_from("<Q", body, 0)
+        offset = 8
+        texts = []
+        for _ in range(3):
+            length, = struct.unpack_from("<H", body, offset)
+            texts.append(bytes(body[offset + 2:offset + 2 + length]).decode())
+            offset += 2 + length
+        record = cls(*texts, detected_ns=detected_ns)
+
+        count = body[offset]
+        record.clips = [bytes(body[offset + 1 + 32 * index:offset + 33 + 32 * index]).hex() for index in range(count)]
+        offset += 1 + 32 * count
+        count = body[offset]
+        offset += 1
+        for _ in range(count):
+            code, ns = struct.unpack_from("<BQ", body, offset)
+            record.stages[STAGES[code]] = ns
+            offset += 9
+        count, = struct.unpack_from("<I", body, offset)
+        offset += 4
+        for _ in range(count):
+            length = body[offset]
+            host = bytes(body[offset + 1:offset + 1 + length]).decode()
+            port, result, ns = struct.unpack_from("<HBQ", body, offset + 1 + length)
+            record.deliveries.append((host, port, result, ns))
+            offset += 1 + length + 11
+        return record
+
+    def to_dict(self):
+        return {
+            'incident_id': self.incident_id,
+            'priority': self.priority,
+            'incident_type': self.incident_type,
+            'clips': self.clips,
+            'stages': self.stages,
+            'deliveries': [{'host': host, 'port': port, 'result': RESULT_NAMES.get(result, str(result)), 'time_ns': ns}
+                           for host, port, result, ns in self.deliveries]
+        }
+
+
+class Journal:
+    """Append-only binary journal of alert records, with an index by time and one by incident ID.
+
+    Records are queued by whichever thread completes them and written by the journal's own thread, so the
+    streaming and writer threads never touch the disk. Each record carries a CRC, and a torn record at the
+    end of the journal after a crash is dropped when it is next opened.
+    """
+
+    def __init__(self, folder):
+        self.folder = Path(folder)
+        self.folder.mkdir(parents=True, exist_ok=True)
+        self.journal_file = open(self.folder / JOURNAL_NAME, "ab+")
+        self.time_index = open(self.folder / TIME_INDEX_NAME, "ab+")
+        self.open_incident_index(INITIAL_INCIDENT_SLOTS)
+        self.newest_detected = 0
+        self.recover()
+
+        self.queue = queue.Queue()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def submit(self, record):
+        self.queue.put(record)
+
+    def close(self):
+        self.queue.put(None)
+        self.thread.join()
+        self.incident_mmap.close()
+        self.incident_file.close()
+        self.time_index.close()
+        self.journal_file.close()
+
+    def run(self):
+        while True:
+            record = self.queue.get()
+            if record is None:
+                return
+            try:
+                self.append(record)
+            except OSError as e:
+                logger.error(f"Could not journal alert {record.incident_id}: {e}")
+
+    def append(self, record):
+        detected_ns = record.stages["detected"]
+        if detected_ns < self.newest_detected - INDEX_SKEW_NS:
+            logger.warning(f"Alert {record.incident_id} completed too long after it was detected; "
+                           f"journal.py --since will not find it, only --incident")
+        self.newest_detected = max(self.newest_detected, detected_ns)
+        body = record.encode()
+        offset = self.journal_file.seek(0, os.SEEK_END)
+        self.journal_file.write(RECORD_HEADER.pack(MAGIC, len(body), zlib.crc32(body)) + body)
+        self.journal_file.flush()
+        self.index(record.stages["detected"], offset, incident_hash(record.incident_id))
+
+    def index(self, detected_ns, offset, hashed):
+        self.time_index.write(TIME_ENTRY.pack(detected_ns, offset, hashed))
+        self.time_index.flush()
+        self.insert_incidents()
+
+    def insert_incidents(self):
+        """Add time index entries not yet in the incident index, growing it when it is half full."""
+        entries = os.fstat(self.time_index.fileno()).st_size // TIME_ENTRY.size
+        slots, inserted = INCIDENT_HEADER.unpack_from(self.incident_mmap, 0)
+        if entries * 2 > slots:
+            self.rebuild_incident_index(max(slots * 2, entries * 4))
+            return
+
+        for entry in range(inserted, entries):
+            self.time_index.seek(entry * TIME_ENTRY.size)
+            _, _, hashed = TIME_ENTRY.unpack(self.time_index.read(TIME_ENTRY.size))
+            slot = hashed % slots
+            while INCIDENT_SLOT.unpack_from(self.incident_mmap, INCIDENT_HEADER.size + slot * INCIDENT_SLOT.size)[1]:
+                slot = (slot + 1) % slots
+            INCIDENT_SLOT.pack_into(self.incident_mmap, INCIDENT_HEADER.size + slot * INCIDENT_SLOT.size,
+                                    hashed, entry + 1)
+        INCIDENT_HEADER.pack_into(self.incident_mmap, 0, slots, entries)
+        self.incident_mmap.flush()
+
+    def open_incident_index(self, slots):
+        path = self.folder / INCIDENT_INDEX_NAME
+        if not path.exists() or not path.stat().st_size:
+            self.create_incident_index(path, slots)
+        self.incident_file = open(path, "r+b")
+        self.incident_mmap = mmap.mmap(self.incident_file.fileno(), 0)
+
+    @staticmethod
+    def create_incident_index(path, slots):
+        temp_path = path.with_suffix(f".{os.getpid()}.tmp")
+        with open(temp_path, "wb") as index_file:
+            index_file.write(INCIDENT_HEADER.pack(slots, 0))
+            index_file.truncate(INCIDENT_HEADER.size + slots * INCIDENT_SLOT.size)
+        os.replace(temp_path, path)
+
+    def rebuild_incident_index(self, slots):
+        self.incident_mmap.close()
+        self.incident_file.close()
+        self.create_incident_index(self.folder / INCIDENT_INDEX_NAME, slots)
+        self.open_incident_index(slots)
+        self.insert_incidents()
+
+    def record_end(self, offset, size):
+        """End offset of the record at offset if it is complete and its CRC matches, otherwise None."""
+        if offset + RECORD_HEADER.size > size:
+            return None
+        self.journal_file.seek(offset)
+        magic, length, crc = RECORD_HEADER.unpack(self.journal_file.read(RECORD_HEADER.size))
+        if magic != MAGIC or offset + RECORD_HEADER.size + length > size:
+            return None
+        if zlib.crc32(self.journal_file.read(length)) != crc:
+            return None
+        return offset + RECORD_HEADER.size + length
+
+    def recover(self):
+        """Bring the journal and its indexes back in line after a crash.
+
+        Trailing time index entries that do not point at a complete record are dropped, complete records
+        the index missed are indexed, and a torn record at the end of the journal is truncated. The
+        incident index is rebuilt if it refers to time index entries that were dropped.
+        """
+        size = os.fstat(self.journal_file.fileno()).st_size
+        entries = os.fstat(self.time_index.fileno()).st_size // TIME_ENTRY.size
+        end = None
+        while entries and end is None:
+            self.time_index.seek((entries - 1) * TIME_ENTRY.size)
+            detected_ns, offset, _ = TIME_ENTRY.unpack(self.time_index.read(TIME_ENTRY.size))
+            end = self.record_end(offset, size)
+            if end is None:
+                entries -= 1
+            else:
+                self.newest_detected = detected_ns
+        end = end or 0
+        if os.fstat(self.time_index.fileno()).st_size != entries * TIME_ENTRY.size:
+            logger.warning(f"Dropping time index entries past the last complete record in {self.folder}")
+            self.time_index.truncate(entries * TIME_ENTRY.size)
+
+        while True:
+            record_end = self.record_end(end, size)
+            if record_end is None:
+                break
+            self.journal_file.seek(end + RECORD_HEADER.size)
+            record = AlertRecord.decode(self.journal_file.read(record_end - end - RECORD_HEADER.size))
+            self.time_index.write(TIME_ENTRY.pack(record.stages["detected"], end, incident_hash(record.incident_id)))
+            self.newest_detected = max(self.newest_detected, record.stages["detected"])
+            end = record_end
+        if end < size:
+            logger.warning(f"Dropping {size - end} bytes of incomplete journal records in {self.folder}")
+            self.journal_file.truncate(end)
+        self.time_index.flush()
+
+        slots, inserted = INCIDENT_HEADER.unpack_from(self.incident_mmap, 0)
+        if not slots or len(self.incident_mmap) != INCIDENT_HEADER.size + slots * INCIDENT_SLOT.size \
+                or inserted > entries:
+            self.rebuild_incident_index(INITIAL_INCIDENT_SLOTS)
+        else:
+            self.insert_incidents()
+
+
+class JournalReader:
+    """Read-only view of a journal folder through memory maps of the journal and its indexes."""
+
+    def __init__(self, folder):
+        self.folder = Path(folder)
+        self.maps = []
+        self.journal = self.map(JOURNAL_NAME)
+        self.time_index = self.map(TIME_INDEX_NAME)
+        self.incident_index = self.map(INCIDENT_INDEX_NAME)
+        self.entries = len(self.time_index) // TIME_ENTRY.size if self.time_index else 0
+        # The journal is mapped before the index, so the newest entries can point past the end of the
+        # mapped journal while the server is appending; stop at the last complete record
+        while self.entries and self.record_span(self.entry(self.entries - 1)[1]) is None:
+            self.entries -= 1
+
+    def map(self, name):
+        path = self.folder / name
+        if not path.exists() or not path.stat().st_size:
+            return None
+        with open(path, "rb") as mapped_file:
+            mapped = mmap.mmap(mapped_file.fileno(), 0, access=mmap.ACCESS_READ)
+        self.maps.append(mapped)
+        return mapped
+
+    def close(self):
+        for mapped in self.maps:
+            mapped.close()
+
+    def entry(self, number):
+        return TIME_ENTRY.unpack_from(self.time_index, number * TIME_ENTRY.size)
+
+    def record_span(self, offset):
+        """(start, length) of the record body at offset, or None if the record runs past the end of the journal."""
+        if not self.journal or offset + RECORD_HEADER.size > len(self.journal):
+            return None
+        magic, length, _ = RECORD_HEADER.unpack_from(self.journal, offset)
+        if magic != MAGIC:
+            raise ValueError(f"No journal record at offset {offset}")
+        start = offset + RECORD_HEADER.size
+        if start + length > len(self.journal):
+            return None
+        return start, length
+
+    def read(self, offset):
+        """The record at offset, or None if it is short, i.e. past the end of the journal as mapped."""
+        span = self.record_span(offset)
+        if span is None:
+            return None
+        start, length = span
+        return AlertRecord.decode(memoryview(self.journal)[start:start + length])
+
+    def by_time(self, start_ns, end_ns):
+        """Records detected within [start_ns, end_ns], found by binary search of the time index.
+
+        The index is in completion order, not detection order. The search relies on no entry being more
+        than INDEX_SKEW_NS older than any entry before it, which holds because the server journals every
+        record within MAX_RECORD_AGE_NS of detection (AudioServer.expire_alerts). Journal.append warns
+        about a record that breaks it; such a record can still be found by incident.
+        """
+        low, high = 0, self.entries
+        while low < high:
+            middle = (low + high) // 2
+            if self.entry(middle)[0] < start_ns - INDEX_SKEW_NS:
+                low = middle + 1
+            else:
+                high = middle
+
+        records = []
+        for number in range(low, self.entries):
+            detected_ns, offset, _ = self.entry(number)
+            if detected_ns > end_ns + INDEX_SKEW_NS:
+                break
+            if start_ns <= detected_ns <= end_ns:
+                records.append(self.read(offset))
+        return records
+
+    def by_incident(self, incident_id):
+        if not self.incident_index:
+            return []
+        hashed = incident_hash(incident_id)
+        slots, inserted = INCIDENT_HEADER.unpack_from(self.incident_index, 0)
+        records = []
+        slot = hashed % slots
+        while True:
+            slot_hash, entry = INCIDENT_SLOT.unpack_from(self.incident_index,
+                                                         INCIDENT_HEADER.size + slot * INCIDENT_SLOT.size)
+            if not entry:
+                break
+            if slot_hash == hashed and entry <= self.entries:
+                record = self.read(self.entry(entry - 1)[1])
+                if record.incident_id == incident_id:
+                    records.append(record)
+            slot = (slot + 1) % slots
+        return records
+
+    def latest(self, count):
+        return [self.read(self.entry(number)[1]) for number in range(max(self.entries - count, 0), self.entries)]
+
+
+def journal_folders(folder):
+    """The journal in folder plus those of any fan-out workers (folder/worker-N)."""
+    folder = Path(folder)
+    return [path for path in [folder, *sorted(folder.glob("worker-*"))] if (path / TIME_INDEX_NAME).exists()]
+
+
+def parse_time(value):
+    try:
+        return int(float(value) * 10 ** 9)
+    except ValueError:
+        return int(datetime.fromisoformat(value).timestamp() * 10 ** 9)
+
+
+def format_time(ns):
+    return datetime.fromtimestamp(ns / 10 ** 9).isoformat(sep=" ", timespec="milliseconds")
+
+
+def print_record(record, station=None):
+    detected = record.stages["detected"]
+    print(f"{format_time(detected)}  {record.priority} {record.incident_type}  [{record.incident_id}]")
+    if record.clips:
+        print(f"  clips: {', '.join(digest[:12] for digest in record.clips)}")
+    stages = sorted(record.stages.items(), key=lambda stage: stage[1])
+    print("  " + ", ".join(f"{name} +{(ns - detected) / 1e6:.0f} ms" for name, ns in stages))
+    for host, port, result, ns in record.deliveries:
+        if station is None or host == station:
+            print(f"  {host}:{port}  {RESULT_NAMES.get(result, result)}  +{(ns - detected) / 1e6:.0f} ms")
+
+
+parser = argparse.ArgumentParser(description="Query the RFAStream alert journal")
+parser.add_argument("--journal", default="journal", help="Journal folder from the server config (Default: journal)")
+parser.add_argument("--incident", help="Incident ID, i.e. the .rfa file name without its extension")
+parser.add_argument("--since", help="Start of the time range: ISO date/time (local) or Unix seconds")
+parser.add_argument("--until", help="End of the time range (Default: now)")
+parser.add_argument("--priority", help="Only alerts of this priority, e.g. P1")
+parser.add_argument("--station", help="Only alerts sent to this station address, and only its delivery result")
+parser.add_argument("--limit", type=int, default=20, help="Most recent alerts shown without --incident or --since")
+parser.add_argument("--json", action="store_true", help="Print records as JSON lines")
+
+
+def main():
+    args = parser.parse_args()
+    folders = journal_folders(args.journal)
+    if not folders:
+        print(f"No journal found in {args.journal}")
+        return
+
+    records = []
+    for folder in folders:
+        reader = JournalReader(folder)
+        try:
+            if args.incident:
+                records += reader.by_incident(args.incident)
+            elif args.since:
+                until = parse_time(args.until) if args.until else time.time_ns()
+                records += reader.by_time(parse_time(args.since), until)
+            else:
+                records += reader.latest(args.limit)
+        finally:
+            reader.close()
+
+    # Each fan-out worker journals its own clients, so the same alert can appear once per worker
+    merged = {}
+    for record in records:
+        key = (record.incident_id, record.stages["detected"])
+        if key in merged:
+            merged[key].deliveries += record.deliveries
+        else:
+            merged[key] = record
+    records = sorted(merged.values(), key=lambda record: record.stages["detected"])
+    if args.priority:
+        records = [record for record in records if record.priority == args.priority.upper()]
+    if args.station:
+        records = [record for record in records if any(host == args.station for host, *_ in record.deliveries)]
+    if not (args.incident or args.since):
+        records = records[-args.limit:]
+
+    for record in records:
+        if args.json:
+            print(json.dumps(record.to_dict()))
+        else:
+            print_record(record, args.station)
+    if not records:
+        print("No matching alerts.")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,130 @@
+import time
+import itertools
+import threading
+import numpy as np
+from collections import defaultdict
+from loguru import logger
+from clip_prep import STREAM_RATE
+
+
+class Voice:
+    """One alert's audio (its clips back to back) and how far through it the mixer is."""
+
+    sequence = itertools.count()
+
+    def __init__(self, alert, samples):
+        self.alert = alert
+        self.samples = samples
+        self.position = 0
+        self.order = next(self.sequence)
+
+    def next_block(self, frames):
+        block = self.samples[self.position:self.position + frames]
+        self.position += frames
+        return block
+
+    def finished(self):
+        return self.position >= len(self.samples)
+
+
+def mix_blocks(blocks, gains):
+    """Weighted sum of int16 blocks of possibly different lengths, clipped back to int16."""
+    stacked = np.zeros((len(blocks), max(len(block) for block in blocks)), dtype=np.float32)
+    for row, block in enumerate(blocks):
+        stacked[row, :len(block)] = block
+    return np.clip(np.asarray(gains, dtype=np.float32) @ stacked, -2 ** 15, 2 ** 15 - 1).astype('<i2')
+
+
+class AlertMixer:
+    """Plays overlapping alerts concurrently instead of one after another.
+
+    A single thread advances every active alert one block at a time. Each client is sent the mix of
+    just the alerts its subscription matches, so stations in different groups get independent streams,
+    and a station matching several alerts hears them together. Within a mix the highest-priority
+    (then oldest) alert plays at full level and the others are ducked by duck_db.
+    """
+
+    def __init__(self, server, shutdown_event, block_frames=2205, duck_db=-12.0, lead_seconds=0.5):
+        self.server = server
+        self.shutdown_event = shutdown_event
+        self.block_frames = block_frames
+        self.duck_gain = 10 ** (duck_db / 20)
+        self.lead_seconds = lead_seconds
+        self.voices = []
+        self.lock = threading.Lock()
+        self.wakeup = threading.Event()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def submit(self, alert, clip_paths):
+        """Queue an alert; clip_paths are source clips that the server's ClipStore prepares."""
+        clips = []
+        try:
+            for path in clip_paths:
+                clips.append(self.server.clips.acquire(path))
+            # Mapped clips are exposed as int16 arrays without copying; only the concatenation copies
+            samples = np.concatenate([np.frombuffer(clip.view[:clip.size - clip.size % 2], dtype='<i2')
+                                      for clip in clips])
+        except FileNotFoundError as e:
+            logger.error(f"Audio file not found for mixing: {e}")
+            return
+        finally:
+            # The samples are a copy, so a clip remapped from now on can be unmapped
+            for clip in clips:
+                clip.close()
+
+        with self.lock:
+            self.voices.append(Voice(alert, samples))
+            logger.info(f"Mixing {alert} ({len(self.voices)} active)")
+        self.wakeup.set()
+
+    def run(self):
+        block_seconds = self.block_frames / STREAM_RATE
+        started = None
+        while not self.shutdown_event.is_set():
+            with self.lock:
+                voices = list(self.voices)
+            if not voices:
+                self.wakeup.wait(1.0)
+                self.wakeup.clear()
+                started = None
+                continue
+
+            # Stay at most lead_seconds ahead of real time so late alerts can join the mix promptly
+            if started is None:
+                started, sent = time.monotonic(), 0.0
+            ahead = started + sent - self.lead_seconds - time.monotonic()
+            if ahead > 0:
+                time.sleep(ahead)
+
+            self.mix_block(voices)
+            sent += block_seconds
+
+            with self.lock:
+                finished = [voice for voice in self.voices if voice.finished()]
+                self.voices = [voice for voice in self.voices if not voice.finished()]
+            for voice in finished:
+                self.server.finish_alert(voice.alert)
+
+    def mix_block(self, voices):
+        blocks = [voice.next_block(self.block_frames) for voice in voices]
+
+        # Group clients by the exact set of alerts they should hear, then mix each set once
+        listening = defaultdict(list)
+        for index, voice in enumerate(voices):
+            recipients = self.server.routes.recipients(voice.alert)
+            self.server.record_streaming(voice.alert, recipients)
+            for client_socket in recipients:
+                listening[client_socket].append(index)
+        audiences = defaultdict(list)
+        for client_socket, indexes in listening.items():
+            audiences[tuple(indexes)].append(client_socket)
+
+        for indexes, clients in audiences.items():
+            if len(indexes) == 1:
+                pcm = blocks[indexes[0]]
+            else:
+                lead = min(indexes, key=lambda index: (voices[index].alert.priority, voices[index].order))
+                gains = [1.0 if index == lead else self.duck_gain for index in indexes]
+                pcm = mix_blocks([blocks[index] for index in indexes], gains)
+            self.server.send_audio(clients, pcm.tobytes())
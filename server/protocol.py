@@ -0,0 +1,18 @@
+import struct
+
+# Clients that negotiate the clip cache receive length-prefixed messages instead of a raw byte stream
+MESSAGE_HEADER = struct.Struct("<BI")  # message type, payload length
+
+MSG_AUDIO = 1  # PCM to play immediately
+MSG_CONTROL = 2  # Control text: PAUSED, RESUMED, HEARTBEAT
+MSG_PLAY = 3  # JSON list of clip digests to play in order
+MSG_OFFER = 4  # JSON list of clip digests the client should fetch if it does not have them
+MSG_CLIP = 5  # 64-character hex digest followed by the clip's PCM
+
+CLIP_CACHE_CAPABILITY = "clip-cache"
+
+# Written on the raw stream to mark where framed messages start
+FRAMED_MARKER = b"CONTROL:FRAMED\n"
+
+# Client commands that end with a newline and may be split across reads
+LINE_COMMANDS = ("SUBSCRIBE:", "CAPABILITIES:", "FETCH:")
@@ -0,0 +1,177 @@
+import json
+import threading
+from collections import defaultdict
+
+
+def normalize_incident_type(incident_type):
+    return incident_type.replace(" ", "_").lower().strip()
+
+
+class Alert:
+    """The parts of an alert that decide which clients receive it, and which incident it is for."""
+
+    def __init__(self, priority, incident_type, groups=(), incident_id=None, detected_ns=None):
+        self.priority = priority
+        self.incident_type = normalize_incident_type(incident_type)
+        self.groups = frozenset(groups)
+        # Identify the alert in the journal; not part of the routing key
+        self.incident_id = incident_id
+        self.detected_ns = detected_ns
+
+    def key(self):
+        return self.priority, self.incident_type, self.groups
+
+    def encode(self):
+        return json.dumps([self.priority, self.incident_type, sorted(self.groups), self.incident_id,
+                           self.detected_ns]).encode()
+
+    @classmethod
+    def decode(cls, data):
+        return cls(*json.loads(data))
+
+    def __repr__(self):
+        return f"Alert({self.priority}, {self.incident_type}, groups={sorted(self.groups)})"
+
+
+class Subscription:
+    """A client's filter. An empty set means "everything" for that field."""
+
+    def __init__(self, muted=False, priorities=(), incident_types=(), groups=()):
+        self.muted = muted
+        self.priorities = frozenset(priority.upper() for priority in priorities)
+        self.incident_types = frozenset(normalize_incident_type(incident_type) for incident_type in incident_types)
+        self.groups = frozenset(groups)
+
+    @classmethod
+    def from_message(cls, payload):
+        """Parse the JSON body of a SUBSCRIBE command. Raises ValueError if it is malformed."""
+        fields = json.loads(payload)
+        if not isinstance(fields, dict):
+            raise ValueError("subscription must be a JSON object")
+
+        # Strings are parsed rather than tested for truth, so "false" and "0" do not mute the station
+        muted = fields.get('muted')
+        if muted is None:
+            muted = False
+        elif isinstance(muted, str):
+            muted = {'true': True, '1': True, 'false': False, '0': False}.get(muted.strip().lower(), muted)
+        elif isinstance(muted, int) and not isinstance(muted, bool) and muted in (0, 1):
+            muted = bool(muted)
+        if not isinstance(muted, bool):
+            raise ValueError("'muted' must be true or false")
+
+        subscription = {'muted': muted}
+        for name in ('priorities', 'incident_types', 'groups'):
+            values = fields.get(name) or []
+            if not isinstance(values, list) or not all(isinstance(value, str) for value in values):
+                raise ValueError(f"'{name}' must be a list of strings")
+            subscription[name] = values
+        return cls(**subscription)
+
+    def __repr__(self):
+        return (f"Subscription(muted={self.muted}, priorities={sorted(self.priorities)}, "
+                f"incident_types={sorted(self.incident_types)}, groups={sorted(self.groups)})")
+
+
+class RoutingIndex:
+    """Inverted index from alert attributes to the clients whose subscriptions match them.
+
+    Recipient sets are memoised per alert key and the memo is dropped whenever any subscription changes,
+    so looking up recipients for every chunk is cheap and filter changes still apply mid-alert.
+    Clients with a local clip cache are tracked too, so streaming can skip them and announcements
+    can target only them.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.subscriptions = {}
+        self.muted = set()
+        self.by_priority = defaultdict(set)
+        self.by_incident_type = defaultdict(set)
+        self.by_group = defaultdict(set)
+        self.any_priority = set()
+        self.any_incident_type = set()
+        self.any_group = set()
+        self.clip_cache_clients = set()
+        self.cache = {}
+
+    def add(self, client, subscription=None):
+        self.update(client, subscription or Subscription())
+
+    def update(self, client, subscription):
+        with self.lock:
+            self._unindex(client)
+            self.subscriptions[client] = subscription
+            if subscription.muted:
+                self.muted.add(client)
+            self._index(client, subscription.priorities, self.by_priority, self.any_priority)
+            self._index(client, subscription.incident_types, self.by_incident_type, self.any_incident_type)
+            self._index(client, subscription.groups, self.by_group, self.any_group)
+            self.cache.clear()
+
+    def remove(self, client):
+        with self.lock:
+            self._unindex(client)
+            self.subscriptions.pop(client, None)
+            self.clip_cache_clients.discard(client)
+            self.cache.clear()
+
+    def set_clip_cache(self, client, enabled):
+        with self.lock:
+            if enabled:
+                self.clip_cache_clients.add(client)
+            else:
+                self.clip_cache_clients.discard(client)
+            self.cache.clear()
+
+    def recipients(self, alert=None, clip_cache=None):
+        """Clients that should receive the alert. With no alert, every unmuted client.
+
+        clip_cache=True keeps only clients with a clip cache, False only those without.
+        """
+        key = (alert.key() if alert else None, clip_cache)
+        with self.lock:
+            recipients = self.cache.get(key)
+            if recipients is None:
+                recipients = self._match(alert)
+                if clip_cache is not None:
+                    recipients = frozenset(client for client in recipients
+                                           if (client in self.clip_cache_clients) == clip_cache)
+                self.cache[key] = recipients
+            return recipients
+
+    def _match(self, alert):
+        matched = set(self.subscriptions) - self.muted
+        if alert is None:
+            return frozenset(matched)
+
+        matched &= self.any_priority | self.by_priority.get(alert.priority, set())
+        matched &= self.any_incident_type | self.by_incident_type.get(alert.incident_type, set())
+        # Alerts without groups go to every group
+        if alert.groups:
+            in_group = set(self.any_group)
+            for group in alert.groups:
+                in_group |= self.by_group.get(group, set())
+            matched &= in_group
+        return frozenset(matched)
+
+    @staticmethod
+    def _index(client, values, index, wildcard):
+        if not values:
+            wildcard.add(client)
+        for value in values:
+            index[value].add(client)
+
+    def _unindex(self, client):
+        subscription = self.subscriptions.get(client)
+        if subscription is None:
+            return
+        self.muted.discard(client)
+        for values, index, wildcard in ((subscription.priorities, self.by_priority, self.any_priority),
+                                        (subscription.incident_types, self.by_incident_type, self.any_incident_type),
+                                        (subscription.groups, self.by_group, self.any_group)):
+            wildcard.discard(client)
+            for value in values:
+                index[value].discard(client)
+                if not index[value]:
+                    del index[value]
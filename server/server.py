@@ -1,11 +1,11 @@
-import threading
 import pyaudio
 import signal
 from pathlib import Path
 import argparse
 from loguru import logger
 from config import load_config
-from audio_server import AudioServer
+from audio_server import AudioServer, shutdown_event
+from fanout import FanoutDispatcher
 from helpers import check_dirs
 
 parser = argparse.ArgumentParser(description="RFAStream Streaming Server")
@@ -13,6 +13,7 @@ parser.add_argument("--host", default="0.0.0.0", help="Server Hostname (Default:
 parser.add_argument("--port", type=int, default=12345, help="Server Port (Default: 12345)")
 parser.add_argument("--watchdog-folder", default="rfa", help="Folder to monitor for .rfa files")
 parser.add_argument("--audio-files", default="wav-files", help="Folder where .wav files are stored")
+parser.add_argument("--workers", type=int, help="Number of fan-out worker processes (Default: 1, single process)")
 
 # pyAudio settings
 CHUNK_SIZE = 1024
@@ -23,8 +24,6 @@ RATE = 44100
 # pyAudio instance
 p = pyaudio.PyAudio()
 
-shutdown_event = threading.Event()
-
 
 def signal_handler(signum, frame):
     logger.info(f"Signal {signum} received. Initiating shutdown...")
@@ -43,7 +42,8 @@ def main():
         'host': args.host or config['host'],
         'port': args.port or config['port'],
         'watchdog_folder': args.watchdog_folder or config['watchdog_folder'],
-        'audio_files': args.audio_files or config['audio_files']
+        'audio_files': args.audio_files or config['audio_files'],
+        'workers': args.workers or config.get('workers', 1)
     })
 
     # Now use the values from config
@@ -56,8 +56,23 @@ def main():
     check_dirs(watchdog_folder)
     check_dirs(audio_files_folder)
 
-    # Start the server
-    server = AudioServer(host, port, config['watchdog_folder'], config['audio_files'])
+    # Start the server. With more than one worker, a dispatcher fans alerts out to worker processes.
+    if config['workers'] > 1:
+        server = FanoutDispatcher(host, port, config['watchdog_folder'], config['audio_files'], config['workers'],
+                                  alert_groups=config.get('alert_groups'),
+                                  clip_preparation=config.get('clip_preparation'),
+                                  mixing=config.get('mixing'),
+                                  streaming=config.get('streaming'),
+                                  admission=config.get('admission'),
+                                  journal=config.get('journal'))
+    else:
+        server = AudioServer(host, port, config['watchdog_folder'], config['audio_files'],
+                             alert_groups=config.get('alert_groups'),
+                             clip_preparation=config.get('clip_preparation'),
+                             mixing=config.get('mixing'),
+                             streaming=config.get('streaming'),
+                             admission=config.get('admission'),
+                             journal=config.get('journal'))
     server.start_folder_monitor()
 
     try:
@@ -1,14 +1,29 @@
 import os
 import re
+import time
+import threading
 from loguru import logger
 from watchdog.events import FileSystemEventHandler, DirCreatedEvent, FileCreatedEvent
 from typing import Union
+from routing import Alert
+
+# Each sendfile call has a fixed cost, so hand the kernel large regions; streaming whole clips
+# would make every client wait for the ones ahead of it to buffer the entire clip
+STREAM_CHUNK_SIZE = 65536
 
 
 class FileHandler(FileSystemEventHandler):
-    def __init__(self, server, audio_files_folder):
+    def __init__(self, server, audio_files_folder, alert_groups=None, clips=None, mixing=False,
+                 chunk_size=STREAM_CHUNK_SIZE):
         self.server = server
         self.audio_files_folder = audio_files_folder  # Store it as an instance variable
+        self.alert_groups = alert_groups or {}  # Incident type -> station groups the alert is sent to
+        self.clips = clips
+        self.mixing = mixing  # Hand alerts to the server's mixer instead of streaming them in turn
+        self.chunk_size = chunk_size
+        if mixing and clips.preparer is None:
+            logger.warning("Mixing needs clip_preparation to convert clips to the stream format. "
+                           "Alerts will be streamed one after another.")
 
     def on_created(self, event: Union[DirCreatedEvent, FileCreatedEvent]) -> None:
         if event.is_directory:
@@ -34,6 +49,10 @@ class FileHandler(FileSystemEventHandler):
 
         logger.info(f"Priority: {incident_priority}, Incident: {keyword_part}")
 
+        incident_type = normalized_keyword.replace(" ", "_")
+        alert = Alert(incident_priority, incident_type, self.alert_groups.get(incident_type, ()), base_name,
+                      time.time_ns())
+
         # Replace spaces with underscores for .wav file matching
         inc_type_wav = normalized_keyword.replace(" ", "_") + ".wav"
         incident_priority_wav = f"{incident_priority}.wav"
@@ -45,34 +64,103 @@ class FileHandler(FileSystemEventHandler):
             logger.debug(f"Found audio file {audio_file_path}")
             logger.debug(f"Found priority audio file {inc_priority_audio_file_path}")
             logger.info(f"Streaming {inc_priority_audio_file_path} and {audio_file_path}")
-            self.stream_audio_sequentially(audio_file_path, inc_priority_audio_file_path)
+            if self.mixing:
+                self.submit_alert(alert, [inc_priority_audio_file_path, audio_file_path])
+            else:
+                self.announce_alert(alert, [inc_priority_audio_file_path, audio_file_path])
+                self.stream_audio_sequentially(audio_file_path, inc_priority_audio_file_path, alert)
+                self.server.finish_alert(alert)
         # If priority wav file not found, just stream incident type wav
         elif os.path.exists(audio_file_path) and not os.path.exists(inc_priority_audio_file_path):
             logger.warning(f"Incident Priority ({inc_priority_audio_file_path}) could not be found. Only playing incident type ({audio_file_path})")
-            self.stream_audio(audio_file_path)
+            if self.mixing:
+                self.submit_alert(alert, [audio_file_path])
+            else:
+                self.announce_alert(alert, [audio_file_path])
+                self.stream_audio(audio_file_path, alert)
+                self.server.finish_alert(alert)
         else:
             logger.error(f"Error: Audio file '{audio_file_path}' not found.")
 
-    def stream_audio_sequentially(self, audio_file_path, priority_audio_path):
+    def submit_alert(self, alert, clip_paths):
+        """Pass the alert's prepared clips to the mixer, which plays it alongside any others in progress."""
+        try:
+            clips = [self.clips.get(path) for path in clip_paths]
+        except FileNotFoundError as e:
+            logger.error(f"Audio file not found: {e}")
+            return
+
+        # The mixer sums raw samples, so a clip still in its source format (WAV header, other rate or
+        # width) would come out as noise. Stream such alerts unmixed instead.
+        unprepared = [clip.path for clip in clips if not clip.prepared]
+        if unprepared:
+            logger.warning(f"Not mixing {alert}: {', '.join(unprepared)} not in the stream format. Streaming it unmixed.")
+            self.announce_alert(alert, clip_paths)
+            for path in clip_paths:
+                self.stream_audio(path, alert)
+            self.server.finish_alert(alert)
+            return
+        self.server.submit_alert(alert, clip_paths, [clip.digest for clip in clips])
+
+    def announce_alert(self, alert, clip_paths):
+        """Send clip IDs to clients with a clip cache; stream_audio then only streams to the others."""
+        try:
+            digests = [self.clips.get(path).digest for path in clip_paths]
+        except FileNotFoundError as e:
+            logger.error(f"Audio file not found: {e}")
+            return
+        self.server.announce_alert(alert, digests)
+
+    def stream_audio_sequentially(self, audio_file_path, priority_audio_path, alert=None):
         """Stream two audio files sequentially to the client."""
         try:
             logger.info(f"Streaming audio files")
 
             # Send the incident priority audio file
-            self.stream_audio(priority_audio_path)
+            self.stream_audio(priority_audio_path, alert)
 
             # Send the incident type audio file
-            self.stream_audio(audio_file_path)
+            self.stream_audio(audio_file_path, alert)
 
             logger.info("Both audio files streamed successfully.")
         except FileNotFoundError as e:
             logger.error(f"Error streaming audio: {e}")
 
-    def stream_audio(self, file_path):
+    def stream_audio(self, file_path, alert=None):
         try:
-            with open(file_path, 'rb') as audio_file:
-                while chunk := audio_file.read(1024):
-                    # Send chunks of audio to all connected clients
-                    self.server.broadcast_audio(chunk)
+            clip = self.clips.acquire(file_path)
         except FileNotFoundError:
             logger.error(f"Audio file not found: {file_path}")
+            return
+
+        # Send chunks of the mapped clip to subscribed clients without reading them into Python
+        try:
+            for offset, count in clip.chunks(self.chunk_size):
+                self.server.broadcast_clip(clip, offset, count, alert)
+        finally:
+            clip.close()
+
+
+class ClipSyncHandler(FileSystemEventHandler):
+    """Re-scans the audio folder once .wav files stop changing, so clients can fetch new clips before an alert."""
+
+    def __init__(self, server, delay=2.0):
+        self.server = server
+        self.delay = delay
+        self.timer = None
+        self.lock = threading.Lock()
+
+    def on_any_event(self, event) -> None:
+        # Opened/closed events are ignored: mapping a clip for a scan must not trigger another scan
+        if event.is_directory or event.event_type not in ("created", "modified", "moved", "deleted"):
+            return
+        if not any(str(path).endswith(".wav") for path in (event.src_path, getattr(event, "dest_path", ""))):
+            return
+
+        # Debounce: a file being copied in fires many events
+        with self.lock:
+            if self.timer:
+                self.timer.cancel()
+            self.timer = threading.Timer(self.delay, self.server.sync_clips)
+            self.timer.daemon = True
+            self.timer.start()
@@ -0,0 +1,233 @@
+import os
+import time
+import socket
+import threading
+from collections import deque
+from loguru import logger
+
+# Streaming and socket tuning; overridden by the "streaming" section of the server config
+DEFAULT_STREAMING = {
+    'chunk_size': 65536,  # Bytes of clip handed to the writers at a time
+    'send_buffer': 262144,  # SO_SNDBUF for client sockets, or None to keep the OS default
+    'tcp_nodelay': True,  # Disable Nagle so small control messages are not held back
+    'tcp_cork': False,  # Linux only: cork while a batch is written so the kernel sends full segments
+    'max_batch': 65536,  # Most bytes coalesced into one sendmsg call
+    'max_pending': 8388608,  # Most bytes buffered for a client (clip regions excluded) before it is disconnected
+    'stall_timeout': 30.0  # A client that accepts no data for this long while some is queued is disconnected
+}
+
+try:
+    IOV_MAX = min(os.sysconf("SC_IOV_MAX"), 512)
+except (AttributeError, ValueError, OSError):
+    IOV_MAX = 64
+
+
+def configure_client_socket(client_socket, send_buffer=None, tcp_nodelay=True, **_):
+    if tcp_nodelay:
+        client_socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    if send_buffer:
+        client_socket.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, send_buffer)
+
+
+class FileRegion:
+    """A byte range of a mapped clip, sent with sendfile rather than copied into the queue.
+
+    While queued, a region holds a reference to its clip, so a clip remapped mid-alert stays open
+    until its last queued region has been sent.
+    """
+
+    def __init__(self, clip, offset, count):
+        self.clip = clip
+        self.offset = offset
+        self.count = count
+
+
+class ClientWriter:
+    """Send queue for one client, drained by its own thread.
+
+    Queued buffers are coalesced into a single sendmsg (writev) call, and adjacent regions of the same
+    clip into a single sendfile call, so the number of send syscalls no longer grows with every chunk.
+    Because each client has its own thread, a slow client no longer delays delivery to the others.
+    A client is disconnected once it has accepted nothing for stall_timeout seconds, or once more than
+    max_pending bytes are buffered for it. Clip regions only reference the mapped clip, so they do not
+    count towards max_pending; a long clip queued in one go costs no memory.
+    """
+
+    def __init__(self, client_socket, client_address, on_error, use_sendfile=True, tcp_cork=False, max_batch=65536,
+                 max_pending=8388608, stall_timeout=30.0, **_):
+        self.client_socket = client_socket
+        self.client_address = client_address
+        self.on_error = on_error
+        self.use_sendfile = use_sendfile
+        self.tcp_cork = tcp_cork and hasattr(socket, "TCP_CORK")
+        self.max_batch = max_batch
+        self.max_pending = max_pending
+        self.stall_timeout = stall_timeout
+
+        # Callers hold `lock` to make a framing decision and its enqueue atomic
+        self.lock = threading.Condition(threading.RLock())
+        self.queue = deque()
+        self.pending = 0  # Buffered bytes queued
+        self.busy = False  # Whether the thread is sending a batch
+        self.progress = time.monotonic()  # When the last batch was sent, or the queue last became non-empty
+        self.closed = False
+        self.framed = False
+        self.send_calls = 0
+        self.bytes_sent = 0
+
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def enqueue(self, *items):
+        """Queue buffers and FileRegions in order. Returns False if the client has been dropped."""
+        with self.lock:
+            if self.closed:
+                return False
+            regions = [item for item in items if isinstance(item, FileRegion)]
+            retained = []
+            for region in regions:
+                if not region.clip.retain():
+                    break
+                retained.append(region)
+            if len(retained) < len(regions):
+                # Drop the whole message rather than queue a header without its body
+                for region in retained:
+                    region.clip.close()
+                logger.warning("Clip was closed before it could be queued. Dropping the message.")
+                return True
+
+            if not self.queue and not self.busy:
+                # The client was idle, so a stall is measured from now
+                self.progress = time.monotonic()
+            for item in items:
+                if not isinstance(item, FileRegion):
+                    item = memoryview(item).cast("B")
+                    if not len(item):
+                        continue
+                    self.pending += len(item)
+                self.queue.append(item)
+            stalled = time.monotonic() - self.progress
+            if self.pending > self.max_pending:
+                logger.warning(f"Client {self.client_address} has {self.pending} bytes buffered, disconnecting it.")
+                self.closed = True
+            elif stalled > self.stall_timeout:
+                logger.warning(f"Client {self.client_address} has accepted no data for {stalled:.0f} s, "
+                               f"disconnecting it.")
+                self.closed = True
+            self.lock.notify()
+            overflowed = self.closed
+
+        if overflowed:
+            # Release queued clips and settle markers outside the lock
+            self.close()
+            self.on_error(self.client_socket)
+        return not overflowed
+
+    def enqueue_marker(self, callback):
+        """Call callback(True) once everything queued so far is sent, or callback(False) if the client is dropped first."""
+        with self.lock:
+            if not self.closed:
+                self.queue.append(callback)
+                self.lock.notify()
+                return
+        callback(False)
+
+    def close(self):
+        with self.lock:
+            self.closed = True
+            regions = [item for item in self.queue if isinstance(item, FileRegion)]
+            markers = [item for item in self.queue if callable(item)]
+            self.queue.clear()
+            self.lock.notify()
+        for region in regions:
+            region.clip.close()
+        for callback in markers:
+            callback(False)
+
+    def run(self):
+        while True:
+            with self.lock:
+                while not self.queue and not self.closed:
+                    self.lock.wait()
+                if self.closed:
+                    return
+                batch = self.take_batch()
+                self.busy = True
+
+            try:
+                self.send_batch(batch)
+                with self.lock:
+                    self.busy = False
+                    self.progress = time.monotonic()
+            except Exception as e:
+                # Anything escaping here would end the thread silently and leave the client queued forever
+                if not self.closed:
+                    logger.error(f"Error sending to client {self.client_address}, removing client: {e}")
+                    self.close()
+                    self.on_error(self.client_socket)
+                return
+            finally:
+                if isinstance(batch, FileRegion):
+                    batch.clip.close()
+
+    def take_batch(self):
+        """Pop a marker, one run of contiguous clip regions or a run of buffers up to max_batch bytes."""
+        first = self.queue.popleft()
+        if callable(first):
+            return first
+        if isinstance(first, FileRegion):
+            offset, count = first.offset, first.count
+            while self.queue and isinstance(self.queue[0], FileRegion) and self.queue[0].clip is first.clip \
+                    and self.queue[0].offset == offset + count:
+                count += self.queue.popleft().count
+                # The merged region keeps the first region's reference to the clip
+                first.clip.close()
+            return FileRegion(first.clip, offset, count)
+
+        buffers, size = [first], len(first)
+        while self.queue and isinstance(self.queue[0], memoryview) and len(buffers) < IOV_MAX \
+                and size + len(self.queue[0]) <= self.max_batch:
+            buffers.append(self.queue.popleft())
+            size += len(buffers[-1])
+        self.pending -= size
+        return buffers
+
+    def send_batch(self, batch):
+        if callable(batch):
+            batch(True)
+            return
+        if self.tcp_cork:
+            self.client_socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_CORK, 1)
+
+        if isinstance(batch, FileRegion):
+            if self.use_sendfile:
+                self.client_socket.sendfile(batch.clip.file, batch.offset, batch.count)
+            else:
+                self.client_socket.sendall(batch.clip.view[batch.offset:batch.offset + batch.count])
+            self.send_calls += 1
+            self.bytes_sent += batch.count
+        else:
+            self.send_buffers(batch)
+
+        # Uncork once the queue is drained so the tail of the batch goes out immediately
+        if self.tcp_cork and not self.queue:
+            self.client_socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_CORK, 0)
+
+    def send_buffers(self, buffers):
+        if not hasattr(self.client_socket, "sendmsg"):
+            # No scatter-gather on this platform (Windows); one joined write is still one syscall
+            data = b"".join(buffers)
+            self.client_socket.sendall(data)
+            self.send_calls += 1
+            self.bytes_sent += len(data)
+            return
+
+        while buffers:
+            sent = self.client_socket.sendmsg(buffers)
+            self.send_calls += 1
+            self.bytes_sent += sent
+            # Drop fully sent buffers and trim a partially sent one
+            while buffers and sent >= len(buffers[0]):
+                sent -= len(buffers.pop(0))
+            if sent:
+                buffers[0] = buffers[0][sent:]